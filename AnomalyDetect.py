@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Flag days whose zone flows stray from their recent history.  For each zone the baseline is the
+median, and the spread the MAD, of the previous `window` days in the results store; a day is
+flagged when its flow is more than k*sqrt(MAD**2 + sigma**2) from the baseline, sigma being that
+day's own spread over the trials.  The spread is floored at absFloor gpm and at relFloor of the
+baseline, as trials that converge on the same answer day after day leave MAD and sigma near
+zero.  All zones and days are done at once on strided window views of the (days, zones) series,
+so several years of history take well under a second.
+"""
+
+import argparse
+import datetime as dt
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import ResultsStore as rs
+
+# flows that run every day, so a zero is a real value rather than a zone that didn't run
+ALWAYS_ON = ['ConstLeak']
+
+def flowLabels(data):
+    return [name for name in data.dtype.names[3:] if not name.startswith(('sigma_', 'toffset_', 'lo_', 'hi_'))]
+
+def dailySeries(data, labels):
+    # (days, zones) arrays of flow and sigma on a calendar grid from the first to the last date,
+    # nan on days with no result and where a zone didn't run
+    dates = [dt.datetime.strptime(d, '%Y-%m-%d').date() for d in data['date']]
+    days = np.array([d.toordinal() for d in dates], dtype=int) - dates[0].toordinal()
+    nDays = days[-1] + 1
+    flows = np.full((nDays, len(labels)), np.nan)
+    sigmas = np.full((nDays, len(labels)), np.nan)
+    for (j, label) in enumerate(labels):
+        flow = data[label].copy()
+        sigma = data['sigma_' + label].copy()
+        if label not in ALWAYS_ON:
+            idle = (flow == 0) & (sigma == 0)
+            flow[idle] = np.nan
+            sigma[idle] = np.nan
+        flows[days, j] = flow
+        sigmas[days, j] = sigma
+    dateStrings = [(dates[0] + dt.timedelta(days=n)).isoformat() for n in range(nDays)]
+    return dateStrings, flows, sigmas
+
+def trailingWindows(series, window):
+    # (days, window, zones) view in which row i holds the window days before day i; days
+    # before the start of the series are nan
+    padded = np.vstack((np.full((window, series.shape[1]), np.nan), series))
+    s0, s1 = padded.strides
+    return as_strided(padded, shape=(series.shape[0], window, series.shape[1]), strides=(s0, s0, s1), writeable=False)
+
+def rollingBaseline(series, window, minPeriods):
+    # trailing median and MAD (scaled to a normal sigma) of each zone; nan where fewer than
+    # minPeriods of the window days have a value
+    windows = trailingWindows(series, window)
+    count = np.sum(~np.isnan(windows), axis=1)
+    enough = count >= max(minPeriods, 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-nan windows
+        median = np.nanmedian(windows, axis=1)
+        mad = 1.4826*np.nanmedian(np.abs(windows - median[:, np.newaxis, :]), axis=1)
+    median[~enough] = np.nan
+    mad[~enough] = np.nan
+    return median, mad
+
+def detect(flows, sigmas, window=28, k=4.0, minPeriods=7, absFloor=0.01, relFloor=0.01):
+    # scores (deviation in units of the combined spread) and the flagged (day, zone) mask
+    median, mad = rollingBaseline(flows, window, minPeriods)
+    spread = np.maximum(np.sqrt(mad**2 + sigmas**2), np.maximum(absFloor, relFloor*np.abs(median)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = (flows - median)/spread
+        flagged = np.abs(flows - median) > k*spread
+    return median, mad, scores, flagged
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resultsDb', help = 'SQLite results store written by ChristieDrModel.py --resultsDb', required=True)
+    parser.add_argument('--start', help = 'first date to report, 20yy-mm-dd (the baseline still uses earlier days)')
+    parser.add_argument('--end', help = 'last date to load, 20yy-mm-dd')
+    parser.add_argument('--window', help = 'baseline window(s) in days, comma separated (default 28)', default='28')
+    parser.add_argument('--k', help = 'flag deviations beyond k combined sigmas (default 4)', type=float, default=4.0)
+    parser.add_argument('--minPeriods', help = 'days with a value needed in a window for a baseline (default 7)', type=int, default=7)
+    parser.add_argument('--absFloor', help = 'least spread in gpm (default 0.01)', type=float, default=0.01)
+    parser.add_argument('--relFloor', help = 'least spread as a fraction of the baseline (default 0.01)', type=float, default=0.01)
+    parser.add_argument('--csv', help = 'write the flagged days to this csv file')
+    args = parser.parse_args()
+
+    store = rs.resultsStore(args.resultsDb)
+    data = store.query(end=args.end)
+    store.close()
+    if len(data) == 0:
+        print('no results in', args.resultsDb)
+        raise SystemExit(0)
+
+    labels = flowLabels(data)
+    dateStrings, flows, sigmas = dailySeries(data, labels)
+
+    rows = []
+    for window in [int(w) for w in args.window.split(',')]:
+        median, mad, scores, flagged = detect(flows, sigmas, window, args.k, args.minPeriods, args.absFloor, args.relFloor)
+        for (i, j) in zip(*np.nonzero(flagged)):
+            if args.start and dateStrings[i] < args.start:
+                continue
+            rows.append((dateStrings[i], labels[j], window, flows[i, j], median[i, j], mad[i, j], sigmas[i, j], scores[i, j]))
+
+    rows.sort()
+    for row in rows:
+        print('{} {:20s} window {:3d}: {:.3f} gpm, baseline {:.3f} mad {:.3f} sigma {:.3f}, {:+.1f} sigmas'.format(*row))
+    print('{} flagged'.format(len(rows)))
+
+    if args.csv:
+        with open(args.csv, 'w') as df:
+            print('date, zone, window, flow, baseline, mad, sigma, score', file=df)
+            for row in rows:
+                print('{}, {}, {}, {:.4f}, {:.4f}, {:.4f}, {:.4f}, {:.2f}'.format(*row), file=df)
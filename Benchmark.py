@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks on synthetic data, so performance can be measured without real household data.
+
+Builds synthetic Hydrawise controllers (nScheds of them with nZones zones each, watering from
+04:00) alongside the fixed RearSched and ConstLeakSched of ChristieDrModel, draws true zone
+flows, toffsets and a leak rate, and generates noisy Flo consumption at the chosen sampling
+interval for nDays days.  The data are also written out as Flo-format csvs and Hydrawise-format
+xlsx workbooks in the usual dataDir layout.  Then loadFloData, loadHydraData, optFunc, findFlows,
+findFlowsBatch (nTrials starts) and the whole ChristieDrModel day fit are timed, reporting seconds, samples/sec and peak memory,
+optionally against a stored baseline.  The fits are checked for recovering the true parameters,
+on the timed data and on data drawn with --nSeeds - 1 further seeds.
+
+The Flo export has minute resolution, so the file and pipeline benchmarks need --step >= 60;
+shorter steps only run the in-memory model benchmarks.
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+
+import WaterModel as wm
+import ProcessFloData as pf
+import ProcessHydrawiseData as ph
+import ChristieDrModel as cdm
+
+# ------------------------------------
+# synthetic data
+
+def syntheticHydraScheds(day, nZones, nScheds, duration=10.0):
+    # controllers 1..nScheds, zones one after another from 04:00, stepping around RearSched
+    scheds = []
+    start = dt.datetime.combine(day, dt.time(4, 0))
+    rearStart = dt.datetime.combine(day, dt.time(6, 30))
+    rearEnd = dt.datetime.combine(day, dt.time(7, 20))
+    for controllerId in range(1, nScheds+1):
+        sched = wm.schedule(controllerId)
+        for z in range(nZones):
+            if start + dt.timedelta(minutes=duration) > rearStart and start < rearEnd:
+                start = rearEnd
+            sched.addZone(start, duration, 'Zone{}{}'.format(controllerId, z+1))
+            start += dt.timedelta(minutes=duration + 2)
+        sched.finalize()
+        scheds.append(sched)
+    return scheds
+
+def syntheticModel(day, nZones, nScheds):
+    RearSched, ConstLeakSched = cdm.buildSchedules(dt.datetime.combine(day, dt.time()))
+    model = wm.model()
+    for sched in syntheticHydraScheds(day, nZones, nScheds) + [RearSched, ConstLeakSched]:
+        model.addSched(sched)
+    return model
+
+def syntheticTruth(model, rng, leakRate):
+    # zone flows 1-12 gpm, toffsets within +-2 min, and leakRate (gpm) for ConstLeak
+    truth = np.zeros(model.nFlows + model.nsched)
+    truth[model.flowIndex()] = rng.uniform(1.0, 12.0, model.nFlows)/60.0
+    truth[model.toffsetIndex()] = rng.uniform(-120.0, 120.0, model.nsched)
+    truth[model.sliceList[-1].start] = leakRate/60.0
+    return truth
+
+def syntheticFlo(model, truth, day, step, noise, rng):
+    # consumption in each step through the day, plus gaussian noise of noise gallons per
+    # minute (scaled to the step), never below zero
+    t0 = dt.datetime.combine(day, dt.time()).timestamp()
+    flowTimes = np.arange(t0, t0 + 86400.0, step)
+    gallons = model.predict(truth, flowTimes) + noise*np.sqrt(step/60.0)*rng.standard_normal(len(flowTimes))
+    return np.column_stack((flowTimes, np.maximum(gallons, 0.0)))
+
+def writeFloCsv(fileName, measFlows):
+    # same layout loadFloData expects: the day's rows between the first and last 'Gallons'
+    # markers, followed by one more row before the last marker
+    timeFormat = pf.timeFormat
+    with open(fileName, 'w') as f:
+        print('"Date","Gallons"', file=f)
+        for (t, gallons) in measFlows:
+            print('"{}","{:.4f}"'.format(dt.datetime.fromtimestamp(t).strftime(timeFormat), gallons), file=f)
+        print('"{}","0.0"'.format(dt.datetime.fromtimestamp(measFlows[-1,0] + 60.0).strftime(timeFormat)), file=f)
+        print('"Date","Gallons"', file=f)
+
+def writeHydraXlsx(fileName, hydraScheds):
+    # one sheet per zone of Date/Time/min rows, one row per day, as exported by Hydrawise.
+    # hydraScheds is the day-by-day list of controller 1 schedules
+    from openpyxl import Workbook
+    wb = Workbook()
+    wb.remove(wb.active)
+    for (z, name) in enumerate(hydraScheds[0].zoneNames):
+        ws = wb.create_sheet(name)
+        ws.append(['Date', 'Time', 'min'])
+        for sched in hydraScheds:
+            for (start, duration) in sched.zoneRuns(z):
+                ws.append([start.date(), start, duration])
+        ws.append(['Total', None, None])  # loadHydraData never reads a sheet's last row
+    wb.save(fileName)
+
+def generate(dataDir, firstDay, nDays, nZones, nScheds, step, leakRate, noise, seed):
+    # returns a list of (dateString, model, truth, measFlows), and writes the files if there's a
+    # dataDir and step allows
+    rng = np.random.default_rng(seed)
+    days = [firstDay + dt.timedelta(days=n) for n in range(nDays)]
+    models = [syntheticModel(day, nZones, nScheds) for day in days]
+    truth = syntheticTruth(models[0], rng, leakRate)
+    generated = []
+    for (day, model) in zip(days, models):
+        dayTruth = truth.copy()
+        dayTruth[model.toffsetIndex()] += rng.uniform(-5.0, 5.0, model.nsched)  # clock drift
+        generated.append((day.isoformat(), model, dayTruth, syntheticFlo(model, dayTruth, day, step, noise, rng)))
+
+    if dataDir and step >= 60.0:
+        workbook = os.path.join(dataDir, 'hydrawise.xlsx')
+        writeHydraXlsx(workbook, [model.schedList[0] for model in models])
+        for (dateString, model, dayTruth, measFlows) in generated:
+            hydraDatafile, floDataFile = cdm.inputFiles(dataDir, dateString)
+            for fileName in (hydraDatafile, floDataFile):
+                os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            shutil.copy(workbook, hydraDatafile)
+            writeFloCsv(floDataFile, measFlows)
+
+    return generated
+
+# ------------------------------------
+# timing
+
+def bestTime(fn, repeats):
+    best = float('inf')
+    for n in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def peakMemory(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def recovered(model, truth, x, flowTol=0.05, toffsetTol=5.0):
+    # every zone flow within flowTol (fractional) and every active toffset within toffsetTol sec
+    flows = model.flowIndex()
+    ok = np.all(np.abs(x[flows] - truth[flows]) <= flowTol*truth[flows])
+    for (i, sched) in enumerate(model.schedList):
+        if sched.maxDuration < 12*3600:  # ConstLeak's toffset is barely constrained
+            j = model.toffsetIndex()[i]
+            ok = ok and abs(x[j] - truth[j]) <= toffsetTol
+    return bool(ok)
+
+def fitters(nTrials):
+    # each fitting method's benchmark name, and its fit of one day's data drawing random starts from rng
+    def batch(model, measFlows, rng):
+        results = wm.findFlowsBatch(model, measFlows, nTrials, rng=rng)
+        return min(results, key=lambda result: result.cost).x
+    return OrderedDict([
+        ('lsq', ('findFlows lsq', lambda model, measFlows, rng: wm.findFlows(model, measFlows, rng=rng).x)),
+        ('varpro', ('findFlows varpro', lambda model, measFlows, rng: wm.findFlows(model, measFlows, method='varpro').x)),
+        ('batch', ('findFlowsBatch', batch))])
+
+def fitDays(generated, fit):
+    rng = np.random.default_rng(0)
+    return [fit(model, measFlows, rng) for (dateString, model, truth, measFlows) in generated]
+
+def recoveredBy(generated, fits):
+    # for each method, whether its fits recovered the true parameters on every day
+    return OrderedDict((method, all(recovered(model, truth, x) for ((d, model, truth, m), x) in zip(generated, fits[method])))
+                       for method in fits)
+
+def runBenchmarks(generated, dataDir, step, repeats, nTrials):
+    nSamples = sum(len(measFlows) for (dateString, model, truth, measFlows) in generated)
+    benchmarks = OrderedDict()
+
+    def optFuncs():
+        for (dateString, model, truth, measFlows) in generated:
+            wm.optFunc(truth, measFlows, model)
+    benchmarks['optFunc'] = (optFuncs, nSamples)
+
+    fits = OrderedDict()
+    for (method, (name, fit)) in fitters(nTrials).items():
+        def fitAll(method=method, fit=fit):
+            fits[method] = fitDays(generated, fit)
+        benchmarks[name] = (fitAll, nSamples)
+
+    if step >= 60.0:
+        def loadFlo():
+            for (dateString, model, truth, measFlows) in generated:
+                pf.loadFloData(cdm.inputFiles(dataDir, dateString)[1], useCache=False)
+        benchmarks['loadFloData'] = (loadFlo, nSamples)
+
+        def loadHydra():
+            for (dateString, model, truth, measFlows) in generated:
+                ph.loadHydraData(cdm.inputFiles(dataDir, dateString)[0], 1,
+                                 dt.datetime.strptime(dateString, '%Y-%m-%d'), useCache=False)
+        benchmarks['loadHydraData'] = (loadHydra, nSamples)
+
+        def pipeline():
+            for (dateString, model, truth, measFlows) in generated:
+                cdm.fitDay(dateString, dataDir, nTrials, seed=0)
+        benchmarks['ChristieDrModel day fit'] = (pipeline, nSamples)
+
+    report = OrderedDict()
+    for name in benchmarks:
+        (fn, n) = benchmarks[name]
+        seconds = bestTime(fn, repeats)
+        report[name] = OrderedDict([('seconds', seconds), ('samplesPerSec', n/seconds),
+                                    ('peakMB', peakMemory(fn)/1e6)])
+
+    return report, fits
+
+def recoveredSeeds(generated, fits, seed, nSeeds, generateArgs, nTrials):
+    # for each method, the seeds whose data its fits recovered the true parameters from: seed's from
+    # the benchmark fits, then nSeeds - 1 more generated in memory and fitted once
+    recovery = OrderedDict((method, []) for method in fits)
+    for n in range(nSeeds):
+        if n > 0:
+            generated = generate(None, *generateArgs, seed=seed + n)
+            fits = OrderedDict((method, fitDays(generated, fit)) for (method, (name, fit)) in fitters(nTrials).items())
+        for (method, ok) in recoveredBy(generated, fits).items():
+            if ok:
+                recovery[method].append(seed + n)
+    return recovery
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nZones', help = 'zones per synthetic Hydrawise controller (default 5)', type=int, default=5)
+    parser.add_argument('--nScheds', help = 'synthetic Hydrawise controllers, besides RearSched and ConstLeakSched (default 1)', type=int, default=1)
+    parser.add_argument('--leak', help = 'constant leak in gpm (default 0.1)', type=float, default=0.1)
+    parser.add_argument('--noise', help = 'measurement noise in gallons per minute (default 0.005)', type=float, default=0.005)
+    parser.add_argument('--step', help = 'sampling interval in seconds, 1 to 60 (default 60)', type=float, default=60.0)
+    parser.add_argument('--nDays', help = 'number of days, up to a month (default 1)', type=int, default=1)
+    parser.add_argument('--date', help = 'first day as 20yy-mm-dd (default 2019-08-01)', default='2019-08-01')
+    parser.add_argument('--nTrials', help = 'trials for findFlowsBatch and the ChristieDrModel day fit (default 5)', type=int, default=5)
+    parser.add_argument('--repeats', help = 'runs per benchmark; the best is reported (default 3)', type=int, default=3)
+    parser.add_argument('--seed', help = 'seed for the synthetic data (default 0)', type=int, default=0)
+    parser.add_argument('--nSeeds', help = 'seeds, from --seed on, whose data the fits must recover the true parameters from (default 10)', type=int, default=10)
+    parser.add_argument('--dataDir', help = 'where to write the synthetic files (default: a temporary directory)')
+    parser.add_argument('--baseline', help = 'json file of baseline results to compare against')
+    parser.add_argument('--save', help = 'write this run to the --baseline file instead of comparing', action='store_true')
+    args = parser.parse_args()
+
+    dataDir = args.dataDir if args.dataDir else tempfile.mkdtemp(prefix='waterbench')
+    firstDay = dt.datetime.strptime(args.date, '%Y-%m-%d').date()
+    generateArgs = (firstDay, args.nDays, args.nZones, args.nScheds, args.step, args.leak, args.noise)
+    generated = generate(dataDir, *generateArgs, seed=args.seed)
+
+    report, fits = runBenchmarks(generated, dataDir, args.step, args.repeats, args.nTrials)
+    recovery = recoveredSeeds(generated, fits, args.seed, max(args.nSeeds, 1), generateArgs, args.nTrials)
+
+    baseline = {}
+    if args.baseline and not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f).get('benchmarks', {})
+
+    print('{} days, {} zones, {} s steps, data in {}'.format(args.nDays, args.nZones*args.nScheds, args.step, dataDir))
+    for name in report:
+        line = '{:26s} {:9.4f} s {:12.0f} samples/s {:8.1f} MB'.format(name, report[name]['seconds'],
+                                                                   report[name]['samplesPerSec'], report[name]['peakMB'])
+        if name in baseline:
+            line += '   x{:.2f} of baseline'.format(report[name]['seconds']/baseline[name]['seconds'])
+        print(line)
+    nSeeds = max(args.nSeeds, 1)
+    for method in recovery:
+        missed = [seed for seed in range(args.seed, args.seed + nSeeds) if seed not in recovery[method]]
+        print('recovered true parameters with {}: {} of {} seeds{}'.format(method, len(recovery[method]), nSeeds,
+              ' (missed {})'.format(', '.join(str(seed) for seed in missed)) if missed else ''))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'benchmarks': report, 'recovery': recovery, 'options': vars(args)}, f, indent=1)
+
+    if not args.dataDir:
+        shutil.rmtree(dataDir)
+
+    # a single random start may legitimately land in a local minimum, so only the deterministic
+    # varpro fit and the best of the batch's nTrials starts decide the exit status
+    sys.exit(0 if all(len(recovery[method]) == nSeeds for method in ('varpro', 'batch')) else 1)
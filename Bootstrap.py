@@ -0,0 +1,76 @@
+"""
+Residual (block) bootstrap of the zone flows about a single fit.  With the toffsets held at the
+fit's, the model is linear in the zone flows, so each replicate -- the fitted flows plus a
+resampling of the residuals -- is refit by one Huber-weighted linear solve, and all the
+replicates are solved together.  Flows are bounded at zero, as in the fit: a replicate whose
+solve has a negative flow is solved again under the bound (NNLS), so the intervals of a zone
+near zero aren't piled up there by clipping.  Residuals are resampled in blocks of consecutive samples, as
+the Flo noise is correlated from one minute to the next; a block length of 1 is the plain
+residual bootstrap.
+"""
+import numpy as np
+from collections import OrderedDict
+from scipy.optimize import nnls
+
+def huberWeights(resids, fScale=1.0):
+    # IRLS weights of least_squares' loss='huber'
+    absResids = np.abs(resids)
+    return np.where(absResids <= fScale, 1.0, fScale/np.maximum(absResids, fScale))
+
+def blockIndices(nSamples, nReplicates, blockLength, rng):
+    # (nReplicates, nSamples) sample indices: randomly placed blocks of blockLength consecutive
+    # samples, end to end, cut to nSamples
+    blockLength = max(1, min(blockLength, nSamples))
+    nBlocks = -(-nSamples // blockLength)
+    starts = rng.integers(0, nSamples - blockLength + 1, size=(nReplicates, nBlocks))
+    indices = starts[:, :, np.newaxis] + np.arange(blockLength)
+    return indices.reshape(nReplicates, -1)[:, :nSamples]
+
+def bootstrapFlows(flowModel, flowMeasurements, solution, nReplicates=1000, blockLength=10, rng=None, fScale=1.0):
+    # (nReplicates, nParams) array of refit solutions, in the layout of solution (gal/sec, toffsets
+    # in sec, the toffsets the same in every replicate)
+    if rng is None:
+        rng = np.random.default_rng()
+
+    toffsets = solution[flowModel.toffsetIndex()]
+    flowCols = flowModel.flowIndex()
+    # the last sample has no interval after it, so it takes no part
+    A = flowModel.design(toffsets, flowMeasurements[:,0])[:-1]
+    y = flowMeasurements[:-1, 1]
+    fitted = np.dot(A, solution[flowCols])
+    resids = y - fitted
+
+    # zones that no sample overlaps keep the fit's value
+    used = np.nonzero(np.any(A != 0, axis=0))[0]
+    A = A[:, used]
+
+    indices = blockIndices(len(y), nReplicates, blockLength, rng)
+    replicateResids = resids[indices]
+    replicateY = fitted + replicateResids
+    weights = huberWeights(replicateResids, fScale)
+
+    # weighted normal equations of every replicate, solved as one batch
+    normal = np.einsum('sp,rs,sq->rpq', A, weights, A)
+    rhs = np.einsum('sp,rs->rp', A, weights*replicateY)
+    zoneFlows = np.linalg.solve(normal, rhs[:, :, np.newaxis])[:, :, 0]
+
+    # with L the cholesky factor of a replicate's normal matrix, |L'x - L^-1 rhs| differs from its
+    # weighted residual norm by a constant, so the small system has the same bounded solution
+    for r in np.nonzero(np.any(zoneFlows < 0, axis=1))[0]:
+        L = np.linalg.cholesky(normal[r])
+        zoneFlows[r] = nnls(L.T, np.linalg.solve(L, rhs[r]))[0]
+
+    replicates = np.tile(solution, (nReplicates, 1))
+    replicates[:, flowCols[used]] = zoneFlows
+    return replicates
+
+def intervals(resultArr, activeFlowLabels, flowData, level=0.95):
+    # (low, high) percentile interval of each column of resultArr, filled into flowData (as from
+    # newFlowData) by label
+    tail = 50.0*(1.0 - level)
+    low, high = np.percentile(resultArr, [tail, 100.0 - tail], axis=0)
+    ciData = OrderedDict(flowData)
+    for n in range(len(activeFlowLabels)):
+        if ciData.get(activeFlowLabels[n]):
+            ciData[activeFlowLabels[n]] = (low[n], high[n])
+    return ciData
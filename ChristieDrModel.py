@@ -5,29 +5,482 @@ from datetime import date
 import WaterModel as wm
 import ProcessFloData as pf
 import ProcessHydrawiseData as ph
-import matplotlib.pyplot as plt
-from matplotlib.font_manager import FontProperties
-from matplotlib.backends.backend_pdf import PdfPages
-from scipy.stats import median_absolute_deviation as mad
+import WarmStart as ws
+import ResultsStore as rs
+import SheetsWriter as sw
+import Metrics as mt
+import JointFit as jf
+import Bootstrap as bs
+import Resample as rsm
+import FloArchive as fa
+import FitCache as fc
 from collections import OrderedDict
-import pickle
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import numpy as np
 import os
 import sys
+import time
 import argparse
 
-def getZoneFlows(model, measFlows):
+# matplotlib and the Google API client are slow to import, so they are only imported
+# by the functions that need them, i.e. with --plot or --updateSheet
+
+def mad(x, axis=0):
+
+    # scipy.stats.median_absolute_deviation, with its default normal scale factor
+
+    center = np.median(x, axis=axis, keepdims=True)
+    return 1.4826 * np.median(np.abs(x - center), axis=axis)
+
+def getZoneFlows(model, measFlows, method='lsq', rng=None, x0=None):
 
     # Solve the model for the zone flows
 
-    result=wm.findFlows(model, measFlows)
+    t0 = time.perf_counter()
+    result=wm.findFlows(model, measFlows, method=method, rng=rng, x0=x0)
+    result.seconds = time.perf_counter() - t0
 
     return result
 
+def runTrial(model, measFlows, method, seed, x0=None):
+
+    # One trial with its own RNG.  In a worker process model is a private copy, so the
+    # setToffset calls made while solving don't touch anyone else's schedules
+
+    return getZoneFlows(model, measFlows, method=method, rng=np.random.default_rng(seed), x0=x0)
+
+def runTrials(model, measFlows, nTrials, method='lsq', workers=None, seed=None, guesses=None):
+
+    # Results come back in trial order.  The batch solver steps all the trials together in
+    # this process, seeded from --seed if given.  Serially with no seed, the trials draw from the
+    # global numpy random state as before; otherwise trial n uses the n-th child of
+    # SeedSequence(seed), so a given seed reproduces the same results for any number of workers.
+    # guesses, if given, holds the initial guess for each trial (see WarmStart)
+
+    if method == 'batch':
+        rng = None if seed is None else np.random.default_rng(seed)
+        return wm.findFlowsBatch(model, measFlows, nTrials, rng=rng, x0=guesses)
+
+    if guesses is None:
+        guesses = [None]*nTrials
+
+    if workers is None and seed is None:
+        return [getZoneFlows(model, measFlows, method=method, x0=x0) for x0 in guesses]
+
+    seeds = np.random.SeedSequence(seed).spawn(nTrials)
+    if workers is None:
+        return [runTrial(model, measFlows, method, s, x0) for (s, x0) in zip(seeds, guesses)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(runTrial, repeat(model), repeat(measFlows), repeat(method), seeds, guesses))
+
+def multiResTrials(model, measFlows, nTrials, binSeconds, method='lsq', workers=None, seed=None, guesses=None, margin=None):
+
+    # Run the trials on the Flo data binned to binSeconds, then refine each from its coarse
+    # solution on the native samples near the zone windows (within margin sec, default
+    # binSeconds), with the rest of the day merged.  Returns the results and the resampled data
+    # they were fit to
+
+    coarseFlows = rsm.binFlows(measFlows, binSeconds)
+    coarse = runTrials(model, coarseFlows, nTrials, method=method, workers=workers, seed=seed, guesses=guesses)
+    toffsets = medianSolution(coarse)[model.toffsetIndex()]
+    fitFlows = rsm.refineFlows(model, measFlows, toffsets, margin=binSeconds if margin is None else margin)
+    # varpro ignores x0, so the refinement is a plain least_squares from the coarse solution
+    results = runTrials(model, fitFlows, nTrials, method='batch' if method == 'batch' else 'lsq', workers=workers,
+                        seed=seed, guesses=np.array([result.x for result in coarse]))
+    print('resample: {} samples, {} coarse, {} refined'.format(len(measFlows), len(coarseFlows), len(fitFlows)))
+
+    return results, fitFlows
+
+def adaptiveTrials(model, measFlows, minTrials, maxTrials, tol, method='lsq', workers=None, seed=None, guesses=None):
+
+    # Run trials in rounds (one trial, or one per worker) until no zone's median flow moves by
+    # tol gpm or more from one round to the next, using at least minTrials and at most maxTrials
+
+    flowCols = model.flowIndex()
+    if seed is not None or workers is not None:
+        seeds = np.random.SeedSequence(seed).spawn(maxTrials)
+    roundSize = workers if workers is not None else 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers is not None else None
+    if guesses is None:
+        guesses = [None]*maxTrials
+
+    results = []
+    lastMeds = None
+    try:
+        while len(results) < maxTrials:
+            n = len(results)
+            nRound = min(roundSize, maxTrials - n)
+            if executor is not None:
+                results.extend(executor.map(runTrial, repeat(model), repeat(measFlows), repeat(method),
+                                            seeds[n:n+nRound], guesses[n:n+nRound]))
+            elif seed is not None:
+                results.append(runTrial(model, measFlows, method, seeds[n], guesses[n]))
+            else:
+                results.append(getZoneFlows(model, measFlows, method=method, x0=guesses[n]))
+
+            meds = np.median([result.x[flowCols] for result in results], axis=0) * 60.0  # gpm
+            if lastMeds is not None and len(results) >= minTrials and np.all(np.abs(meds - lastMeds) < tol):
+                break
+            lastMeds = meds
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return results
+
+def buildSchedules(testDate, oldSched=False):
+
+    # ------------------------------------
+    # Set up schedules, variable and fixed
+    
+    # Schedule constant over 24 hours, representing a fixed leak
+    # Currently set to reflect the fact that we turn the system on and off daily to minimize the leak...
+
+    ConstLeakSched = wm.schedule(3)
+    ConstLeakSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('00:00','%H:%M').time()), 23.95*60.0, 'Const Leak')
+    ConstLeakSched.finalize()
+
+    # This is the fixed schedule (except for clock drift) for
+    # the irrigation controller in the rear of the house
+
+    RearSched = wm.schedule(2)
+    if oldSched:
+        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('05:30','%H:%M').time()), 10.0, 'Lawn')
+        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('05:40','%H:%M').time()), 15.0, 'Fruit Trees')
+        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('05:55','%H:%M').time()), 5.0, 'Planter')
+        RearSched.finalize()
+    else:
+        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('06:38','%H:%M').time()), 10.0, 'Lawn')
+        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('06:53','%H:%M').time()), 15.0, 'Fruit Trees')
+        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('07:08','%H:%M').time()), 5.0, 'Planter')
+        RearSched.finalize()
+
+    return RearSched, ConstLeakSched
+
+def inputFiles(dataDir, testDateString):
+
+    hydraDatafile = os.path.join(dataDir, 'Hydrawise', testDateString, 'hydrawise-Watering Time (min).xlsx')
+    floDataFile = os.path.join(dataDir, 'Flo', testDateString, 'total-consumption-last-day.csv')
+    return hydraDatafile, floDataFile
+
+def missingInputs(hydraDatafile, floDataFile, testDateString, archive=None):
+
+    # the input files that aren't there.  With an archive (file name) that has the date, read
+    # under the current time zone, the Flo csv isn't needed
+
+    needed = [hydraDatafile]
+    if archive is None or not fa.floArchive(archive).has(testDateString):
+        needed.append(floDataFile)
+    return [f for f in needed if not os.path.exists(f)]
+
+def loadFlo(floDataFile, testDateString, archive=None):
+
+    # the day's Flo data from the archive if given and it has the date (read under the current
+    # time zone), otherwise from the csv
+
+    if archive is not None:
+        floArchive = fa.floArchive(archive)
+        if floArchive.has(testDateString):
+            return floArchive.day(testDateString)
+    return pf.loadFloData(floDataFile)
+
+def buildModel(HydraSched, RearSched, ConstLeakSched):
+
+    model = wm.model()
+
+    if HydraSched is not None:
+        model.addSched(HydraSched)
+    model.addSched(RearSched)
+    model.addSched(ConstLeakSched)
+
+    activeFlowLabels = []
+    for sched in model.schedList:
+        for name in sched.zoneNames:
+            activeFlowLabels.append(name.translate({ord(' '):None}))
+        activeFlowLabels.append('toffset')
+
+    return model, activeFlowLabels
+
+def newFlowData():
+
+    # Data structure for all flows, both active and inactive
+
+    return OrderedDict([('FrontOrangeMesquite',(0, 0)), ('NorthHillside',(0, 0)), ('SouthHillside',(0, 0)), ('EastPlanter',(0, 0)), ('SouthPalm',(0, 0)), ('Lawn',(0, 0)), ('FruitTrees',(0, 0)), ('Planter',(0, 0)), ('ConstLeak',(0, 0))])
+
+def makeResultArr(results, model):
+
+    resultArr = np.zeros((len(results), model.nFlows + model.nsched))
+    for (n, result) in enumerate(results):
+        resultArr[n, :] = result.x
+        resultArr[n, :-1] *= 60.0  # gps to gpm
+
+    return resultArr
+
+def summarize(resultArr, activeFlowLabels):
+
+    meds = np.median(resultArr, axis=0)
+    mads = mad(resultArr, axis=0)
+
+    flowData = newFlowData()
+    for n in range(len(meds)):
+        if flowData.get(activeFlowLabels[n]):
+            flowData[activeFlowLabels[n]] = (meds[n], mads[n])
+
+    return meds, mads, flowData
+
+def bootstrapSummary(results, model, measFlows, activeFlowLabels, nReplicates, blockLength=10, level=0.95, seed=None):
+
+    # meds, mads and flowData as from summarize, but over bootstrap replicates about the
+    # lowest-cost trial, plus ciData holding each flow's (low, high) interval
+
+    best = min(results, key=lambda result: result.cost)
+    replicates = bs.bootstrapFlows(model, measFlows, best.x, nReplicates, blockLength, np.random.default_rng(seed))
+    replicates[:, :-1] *= 60.0  # gps to gpm, as in makeResultArr
+    meds, mads, flowData = summarize(replicates, activeFlowLabels)
+    ciData = bs.intervals(replicates, activeFlowLabels, newFlowData(), level)
+
+    return meds, mads, flowData, ciData
+
+def medianSolution(results):
+
+    # median of the raw solutions (gal/sec, toffsets in sec), as kept by the warm-start cache
+
+    return np.median([result.x for result in results], axis=0)
+
+def warmGuesses(warmStart, model, testDateString, nTrials, seed=None):
+
+    # initial guesses from the warm-start cache file, or None to use random guesses
+
+    if warmStart is None or not os.path.exists(warmStart):
+        return None
+    cache = ws.warmStartCache(warmStart)
+    return cache.guesses(model, testDateString, nTrials, np.random.default_rng(seed))
+
+def warmSource(warmStart, model, testDateString):
+
+    # the previous solution that warmGuesses scatters about (nan where there's no history), or
+    # None without a warm start or any history.  It goes into the FitCache key rather than the
+    # guesses, which are random unless seeded
+
+    if warmStart is None or not os.path.exists(warmStart):
+        return None
+    values = ws.warmStartCache(warmStart).lookup(testDateString, ws.paramLabels(model))
+    if all(value is None for value in values):
+        return None
+    return np.array([np.nan if value is None else value for value in values])
+
+def cacheOptions(nTrials, method, seed, adaptive=None, resample=None, margin=None, nBootstrap=0, blockLength=10, level=0.95):
+
+    # the options that decide a fit, for its FitCache key.  adaptive is (minTrials, tol) if used
+
+    return OrderedDict([('nTrials', nTrials), ('method', method), ('seed', seed), ('adaptive', adaptive),
+                        ('resample', [resample, margin] if resample else None),
+                        ('bootstrap', [nBootstrap, blockLength, level] if nBootstrap else None)])
+
+def fitDay(testDateString, dataDir, nTrials, method='lsq', oldSched=False, seed=None, warmStart=None, report=False, nBootstrap=0, blockLength=10,
+           resample=None, archive=None, cacheDir=None, cacheBytes=None, seeded=True, level=0.95, margin=None, metricsFile=None):
+
+    # Load, build and fit one day, as done by the --start/--end backfill workers.  With a
+    # cacheDir the fit is looked up in, or added to, the FitCache there; unless seeded, the seed
+    # is fresh entropy and is left out of the key.  With a metricsFile the day's stage timings
+    # and solver statistics are appended to it, each worker writing whole lines.
+    # Returns (testDateString, flowData, [], warm-start labels, median solution, ciData), ciData
+    # being None without a bootstrap, or (testDateString, None, missing input files, None, None, None)
+
+    testDate = dt.datetime.strptime(testDateString, '%Y-%m-%d')
+    hydraDatafile, floDataFile = inputFiles(dataDir, testDateString)
+    missing = missingInputs(hydraDatafile, floDataFile, testDateString, archive)
+    if missing:
+        return testDateString, None, missing, None, None, None
+
+    dayMetrics = mt.metrics(metricsFile, date=testDateString)
+    RearSched, ConstLeakSched = buildSchedules(testDate, oldSched)
+    with dayMetrics.stage('hydrawise'):
+        HydraSched = ph.loadHydraData(hydraDatafile, 1, checkDate=testDate)
+    with dayMetrics.stage('flo'):
+        measFlows = loadFlo(floDataFile, testDateString, archive)
+    with dayMetrics.stage('model'):
+        model, activeFlowLabels = buildModel(HydraSched, RearSched, ConstLeakSched)
+        guesses = warmGuesses(warmStart, model, testDateString, nTrials, seed)
+
+    cache = fc.fitCache(cacheDir, cacheBytes) if cacheDir else None
+    if cache:
+        key = fc.fitKey(measFlows, model, cacheOptions(nTrials, method, seed if seeded else None, resample=resample, margin=margin, nBootstrap=nBootstrap,
+                                                       blockLength=blockLength, level=level), warmSource(warmStart, model, testDateString))
+        cached = cache.load(key)
+        dayMetrics.record('cache', key=key, hit=cached is not None)
+    if cache and cached:
+        results, fitFlows, meds, mads, flowData, ciData = cached
+    else:
+        fitFlows = measFlows
+        with dayMetrics.stage('trials', solver=method):
+            if resample:
+                results, fitFlows = multiResTrials(model, measFlows, nTrials, resample, method=method, seed=seed, guesses=guesses, margin=margin)
+            else:
+                results = runTrials(model, measFlows, nTrials, method=method, seed=seed, guesses=guesses)
+        for (n, result) in enumerate(results):
+            dayMetrics.solverStats(n, result)
+        ciData = None
+        if nBootstrap:
+            with dayMetrics.stage('bootstrap', replicates=nBootstrap, blockLength=blockLength):
+                meds, mads, flowData, ciData = bootstrapSummary(results, model, measFlows, activeFlowLabels, nBootstrap, blockLength, level, seed)
+        else:
+            meds, mads, flowData = summarize(makeResultArr(results, model), activeFlowLabels)
+        if cache:
+            cache.store(key, results, fitFlows, meds, mads, flowData, ciData)
+    if report:
+        with dayMetrics.stage('plot'):
+            plotSummary(results, model, measFlows, testDateString, '{}-summary.pdf'.format(testDateString))
+    dayMetrics.close()
+
+    return testDateString, flowData, [], ws.paramLabels(model), medianSolution(results), ciData
+
+def writeDataOut(dataOut, rows, csv=False):
+
+    # rows is a list of (time, flowData)
+    # check for existence.  if exists just append line.  if not, put out header line first
+    if os.path.exists(dataOut):
+        df = open(dataOut,'a')
+    else:
+        df = open(dataOut,'w')
+        flowData = rows[0][1]
+        if csv:
+            print('time', end=', ', file=df)
+            for (n, label) in enumerate(flowData):
+                if n == len(flowData) - 1:
+                    endstr = ''
+                else:
+                    endstr = ', '
+                print(label, ', ', 'sigma_'+label, end=endstr, file=df)
+        else:
+            print('# time', end=' ', file=df)
+            for label in flowData:
+                print(label, ' ', 'sigma_'+label, end=' ', file=df)
+        print('', file=df)
+
+    for (t, flowData) in rows:
+        if csv:
+            print(t, end=', ', file=df)
+        else:
+            print(t, end=' ', file=df)
+
+        for (n, flow) in enumerate(flowData):
+            median, sigma = flowData[flow]
+            # if csv and last item, endstr = '', else endstr = ', '
+            if csv:
+                if n == len(flowData) - 1:
+                    endstr = ''
+                else:
+                    endstr = ', '
+                print('{:.3f}, {:.3f}'.format(median, sigma), end=endstr, file=df)
+            else:
+                print('{:.3f} {:.3f}'.format(median, sigma), end=' ', file=df)
+        print('', file=df)
+    df.close()
+
+def backfillDates(args):
+
+    startDate = dt.datetime.strptime(args.start, '%Y-%m-%d').date()
+    endDate = dt.datetime.strptime(args.end, '%Y-%m-%d').date()
+    return [(startDate + dt.timedelta(days=n)).isoformat() for n in range((endDate - startDate).days + 1)]
+
+def backfill(args, nTrials, dataDir):
+
+    # Fit every day from --start to --end, in parallel across days, and write the results in date order
+
+    dateStrings = backfillDates(args)
+    cacheDir = None if args.noCache else args.cacheDir
+
+    # the workers would otherwise share one copy of the global random state, so every day
+    # gets its own seed derived from --seed (or fresh entropy, which is logged)
+    seed = args.seed if args.seed is not None else np.random.SeedSequence().entropy
+    print('backfill seed: ', seed)
+    daySeeds = [[seed, dt.datetime.strptime(d, '%Y-%m-%d').toordinal()] for d in dateStrings]
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        dayResults = list(executor.map(fitDay, dateStrings, repeat(dataDir), repeat(nTrials), repeat(args.solver),
+                                       repeat(args.oldSched), daySeeds, repeat(args.warmStart), repeat(args.report),
+                                       repeat(args.bootstrap), repeat(args.blockLength), repeat(args.resample),
+                                       repeat(args.archive), repeat(cacheDir), repeat(args.cacheSize*2**20),
+                                       repeat(args.seed is not None), repeat(args.ci), repeat(args.margin), repeat(args.metrics)))
+
+    writeBackfill(args, dayResults, nTrials)
+
+def jointBackfill(args, dataDir, runMetrics=None):
+
+    # Fit the days from --start to --end together, with each zone flow shared across the days
+
+    runMetrics = runMetrics or mt.metrics()
+
+    joint = jf.jointModel(shareLeak=args.shareLeak)
+    dayResults = []
+    for testDateString in backfillDates(args):
+        testDate = dt.datetime.strptime(testDateString, '%Y-%m-%d')
+        hydraDatafile, floDataFile = inputFiles(dataDir, testDateString)
+        missing = missingInputs(hydraDatafile, floDataFile, testDateString, args.archive)
+        if missing:
+            dayResults.append((testDateString, None, missing, None, None, None))
+            continue
+        RearSched, ConstLeakSched = buildSchedules(testDate, args.oldSched)
+        with runMetrics.stage('hydrawise', date=testDateString):
+            HydraSched = ph.loadHydraData(hydraDatafile, 1, checkDate=testDate)
+        with runMetrics.stage('flo', date=testDateString):
+            measFlows = loadFlo(floDataFile, testDateString, args.archive)
+        model, activeFlowLabels = buildModel(HydraSched, RearSched, ConstLeakSched)
+        joint.addDay(testDateString, model, measFlows)
+
+    if joint.days:
+        with runMetrics.stage('fit', days=len(joint.days), nParams=joint.nParams()):
+            result = jf.jointFit(joint)
+        runMetrics.solverStats(0, result)
+        print('joint fit: {} parameters, {} evaluations, status {}'.format(joint.nParams(), result.nfev, result.status))
+        for ((testDateString, model, measFlows, cols), (d, flowData, toffsets)) in zip(joint.days, jf.dayFlowData(joint, result, newFlowData())):
+            dayResults.append((testDateString, flowData, [], ws.paramLabels(model), result.x[cols], None))
+    dayResults.sort(key=lambda dayResult: dayResult[0])
+
+    writeBackfill(args, dayResults, 1)
+
+def writeBackfill(args, dayResults, nTrials):
+
+    # dayResults as from fitDay, in date order
+    # the days run in parallel, so each starts from the cache as it stood before the backfill
+    if args.warmStart:
+        cache = ws.warmStartCache(args.warmStart)
+
+    if args.resultsDb:
+        store = rs.resultsStore(args.resultsDb)
+
+    rows = []
+    for (testDateString, flowData, missing, labels, solution, ciData) in dayResults:
+        if flowData is None:
+            print('skipped {}: missing {}'.format(testDateString, ', '.join(missing)))
+            continue
+        if args.warmStart:
+            cache.store(testDateString, labels, solution)
+        t = dt.datetime.strptime(testDateString, '%Y-%m-%d').timestamp()
+        rows.append((t, flowData))
+        if args.resultsDb:
+            store.upsert(testDateString, t, flowData, rs.toffsetsFromSolution(labels, solution), nTrials, ciData)
+        if not args.dataOut:
+            for label in flowData:
+                if ciData is not None and flowData[label] != (0, 0):
+                    print(testDateString, label, flowData[label][0], flowData[label][1], ciData[label][0], ciData[label][1])
+                else:
+                    print(testDateString, label, flowData[label][0], flowData[label][1])
+
+    print('backfill: fit {} of {} days'.format(len(rows), len(dayResults)))
+    if args.updateSheet and rows:
+        updateSheet(rows, args.sheetsUrl)
+    if args.warmStart and rows:
+        cache.save()
+    if args.resultsDb:
+        store.close()
+    if args.dataOut and rows:
+        writeDataOut(args.dataOut, rows, csv=args.csv)
+
 def printResult(result, model, full=False):
 
     if full:
@@ -36,6 +489,8 @@ def printResult(result, model, full=False):
 
 def plotResids(result, model, measFlows, timeDateString, pp):
 
+    import matplotlib.pyplot as plt
+
     resids = wm.formatResids(measFlows, result.fun)
     plt.figure()
     plt.plot(resids[:,0], resids[:,1], '.')
@@ -44,14 +499,12 @@ def plotResids(result, model, measFlows, timeDateString, pp):
 
     flowTimes = measFlows[:,0]
     flows = result.x
-    flowPredict = np.zeros_like(measFlows[:,1])
     for (i, sched) in enumerate(model.schedList):
         parameterBlock = flows[model.sliceList[i]]
         zoneFlows = parameterBlock[0:sched.nzones]
         tOffset = parameterBlock[-1]
         sched.setToffset(tOffset)
-        for i in range(len(flowTimes)-1):
-            flowPredict[i] = sched.flowIntegral(zoneFlows, flowTimes[i], flowTimes[i+1])
+        flowPredict = sched.integrals(zoneFlows, flowTimes)
         plt.plot(resids[:,0], flowPredict)
 
     wm.printResult(result, model, plotLegend=True)
@@ -60,15 +513,15 @@ def plotResids(result, model, measFlows, timeDateString, pp):
     plt.title(timeDateString)
 
     plt.savefig(pp, format='pdf')
+    plt.close()
 
 def plotScheds(result, model, measFlows, timeDateString, pp):
 
+    import matplotlib.pyplot as plt
+
     flowTimes = measFlows[:,0]
     plotTimes = np.arange(np.amin(flowTimes), np.amax(flowTimes), 10.0)
-    plotHours = np.zeros_like(plotTimes)
-    for i in range(len(plotTimes)):
-        t = dt.datetime.fromtimestamp(plotTimes[i])
-        plotHours[i] = t.time().hour + t.time().minute/60.0
+    plotHours = wm.timeOfDay(plotTimes)
 
     plt.figure()
 
@@ -86,82 +539,107 @@ def plotScheds(result, model, measFlows, timeDateString, pp):
     plt.title(timeDateString)
 
     plt.savefig(pp, format='pdf')
+    plt.close()
 
-def updateSheet(time, flowData):
-    # first part copied from Google sheet API quickstart.py
-
-    # If modifying these scopes, delete the file token.pickle.
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-
-    creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-
-    service = build('sheets', 'v4', credentials=creds)
-
-    # with API ready to go connect to the spreadsheet, and append the data as a new row
-
-    valueList = [time]
-    for (n, flow) in enumerate(flowData):
-        median, sigma = flowData[flow]
-        valueList.append(median)
-        valueList.append(sigma)
-        
-    valueList.append(dt.date.fromtimestamp(time).isoformat())
-    
-    values = [ valueList ]
-    body = {
-        'values': values
-    }
+def plotSummary(results, model, measFlows, timeDateString, fileName):
+
+    # One page for all the trials: the data, the prediction of the median solution and the
+    # range of the trials' predictions, with the median solution as the legend
+
+    import matplotlib
+    matplotlib.use('Agg')  # also runs in backfill worker processes
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    flowTimes = measFlows[:,0]
+    plotHours = wm.timeOfDay(flowTimes)
+    solution = medianSolution(results)
+    medPredict = model.predict(solution, flowTimes)
+    trialPredicts = model.batchPredict(np.array([result.x for result in results]), flowTimes)
+
+    plt.figure()
+    plt.plot(plotHours, measFlows[:,1], '.', markersize=2, label='measured')
+    plt.fill_between(plotHours, np.amin(trialPredicts, axis=0), np.amax(trialPredicts, axis=0),
+                     alpha=0.3, step='post', label='trial range')
+    plt.plot(plotHours, medPredict, drawstyle='steps-post', label='median solution')
+    plt.plot(plotHours, measFlows[:,1] - medPredict, '.', markersize=1, label='residual')
+
+    wm.printResult(wm.OptimizeResult(x=solution), model, plotLegend=True)
+    plt.legend(loc='upper left', fontsize=6)
+    plt.yscale('symlog')
+    plt.xlim(4.0, 8.0)
+    plt.title('{}: {} trials'.format(timeDateString, len(results)))
+
+    pp = PdfPages(fileName)
+    plt.savefig(pp, format='pdf')
+    pp.close()
+    plt.close()
+
+def updateSheet(rows, sheetsUrl=None):
+
+    # rows is a list of (time, flowData).  They go into the local outbox, and everything
+    # pending there is appended to the sheet in one call
 
-    range_name = 'Model Fit'
-    spreadsheet_id = os.environ['CHRISTIE_WATER_DOC']
-    value_input_option = 'USER_ENTERED'
-    insert_data_option = 'INSERT_ROWS'
-    result = service.spreadsheets().values().append(
-        spreadsheetId=spreadsheet_id, range=range_name, insertDataOption=insert_data_option,
-        valueInputOption=value_input_option, body=body).execute()
+    sw.queueRows([sw.sheetRow(t, flowData) for (t, flowData) in rows])
+    if sheetsUrl:
+        transport = sw.restTransport(sheetsUrl)
+    else:
+        transport = sw.googleTransport()
+    nSent = sw.flushOutbox(transport, os.environ['CHRISTIE_WATER_DOC'])
+    print('sheet: appended {} rows, {} still pending'.format(nSent, len(sw.pendingRows())))
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--date', help = 'date as 20yy-mm-dd')
+    parser.add_argument('--start', help = 'first date of a backfill range as 20yy-mm-dd; days are fit in parallel')
+    parser.add_argument('--end', help = 'last date of a backfill range as 20yy-mm-dd')
+    parser.add_argument('--joint', help = 'with --start/--end, fit the days together with shared zone flows and per-day toffsets and leak', action='store_true')
+    parser.add_argument('--shareLeak', help = 'with --joint, share the constant leak across the days too', action='store_true')
     parser.add_argument('--plot', help = 'output plots to a pdf file named {date}.pdf', action='store_true')
+    parser.add_argument('--report', help = 'output a one-page summary of all trials to {date}-summary.pdf (rendered by the workers in a backfill)', action='store_true')
     parser.add_argument('--csv', help = 'output data file specified by --dataOut in csv format', action='store_true')
     parser.add_argument('--print', help = 'print results of each trial', action='store_true')
     parser.add_argument('--oldSched', help = 'use schedule from before 7/21/19 change', action='store_true')
     parser.add_argument('--updateSheet', help = 'append results to Google sheet identified by environment variable $SHEET_ID' , action='store_true')
+    parser.add_argument('--sheetsUrl', help = 'with --updateSheet, post to the Sheets REST api at this base url (e.g. a local test server) instead of Google')
     parser.add_argument('--dataDir', help = 'directory root for Flo and Hydrawise data')
+    parser.add_argument('--archive', help = 'read the Flo data from this archive (see FloArchive.py) for the dates it has, rather than from the csv files')
     parser.add_argument('--dataOut', help = 'file to append output data')
     parser.add_argument('--nTrials', help = 'number of solutions from random initial guesses on which to base statistics', type=int)
+    parser.add_argument('--workers', help = 'run the trials (or with --start/--end, the days) on a pool of this many processes (default: serial, or all cores for a backfill)', type=int)
+    parser.add_argument('--seed', help = 'seed for the initial guesses, to reproduce a run', type=int)
+    parser.add_argument('--adaptive', help = 'stop adding trials once every zone median has settled within --tol; --nTrials is then the maximum', action='store_true')
+    parser.add_argument('--minTrials', help = 'minimum number of trials in --adaptive mode (default 5)', type=int, default=5)
+    parser.add_argument('--tol', help = 'zone median tolerance in gpm for --adaptive (default 0.01)', type=float, default=0.01)
+    parser.add_argument('--resultsDb', help = 'SQLite results store to upsert this date\'s medians, sigmas, toffsets, trial count and any --bootstrap intervals into')
+    parser.add_argument('--exportCsv', help = 'write the whole --resultsDb store to this csv file and exit')
+    parser.add_argument('--warmStart', help = 'json file of previous daily solutions: start the fits from the most recent one, and add this day to it')
+    parser.add_argument('--bootstrap', help = 'take the sigmas from this many residual-bootstrap replicates about the best trial, rather than from the spread of the trials', type=int, default=0)
+    parser.add_argument('--blockLength', help = 'samples per block in the --bootstrap resampling (default 10; 1 for the plain residual bootstrap)', type=int, default=10)
+    parser.add_argument('--ci', help = 'level of the --bootstrap intervals, which go into --resultsDb as lo_ and hi_ columns (default 0.95)', type=float, default=0.95)
+    parser.add_argument('--resample', help = 'fit first to the Flo data binned to this many seconds, then refine on the native samples near the zone windows', type=float)
+    parser.add_argument('--margin', help = 'with --resample, keep native samples within this many seconds of a window edge (default: the bin length)', type=float)
+    parser.add_argument('--cacheDir', help = 'directory of cached fits (default: fitCache under --dataDir)')
+    parser.add_argument('--cacheSize', help = 'size limit of --cacheDir in MB; the least recently used fits go first (default 200)', type=float, default=200.0)
+    parser.add_argument('--no-cache', help = 'always fit, and don\'t add the fit to the cache', dest='noCache', action='store_true')
+    parser.add_argument('--metrics', help = 'append stage timings and solver statistics to this json-lines file')
+    parser.add_argument('--solver', help = 'lsq: random initial guesses (default); varpro: deterministic toffset search, one trial suffices; batch: all random starts solved together', choices=['lsq', 'varpro', 'batch'], default='lsq')
     args = parser.parse_args()
+    if args.adaptive and args.solver == 'batch':
+        parser.error('--adaptive does not apply to --solver batch, which runs all trials at once')
+    if args.adaptive and args.resample:
+        parser.error('--adaptive does not apply to --resample, which runs its trials in two passes')
+    if (args.start is None) != (args.end is None):
+        parser.error('--start and --end go together')
+    if args.joint and not args.start:
+        parser.error('--joint needs --start and --end')
+    if args.start and (args.adaptive or args.plot or args.print):
+        parser.error('--adaptive, --plot and --print are for a single --date; a backfill can use --report for per-day plots')
 
     print('plot: ',args.plot)
     
-    if args.date:
-        testDateString = args.date
-    else:
-        testDateString = date.today().isoformat()
-
-    print(args.date, testDateString)
-    testDate = dt.datetime.strptime(testDateString, '%Y-%m-%d')
-
     if args.dataDir:
         dataDir = args.dataDir
     else:
@@ -169,148 +647,153 @@ if __name__ == '__main__':
 
     print('datadir: ', dataDir)
 
+    if args.cacheDir is None:
+        args.cacheDir = os.path.join(dataDir, fc.CACHE_DIR)
+
     if args.nTrials:
         nTrials = args.nTrials
+    elif args.solver == 'varpro':
+        nTrials = 1
     else:
         nTrials = 5
 
     print('nTrials: ', nTrials)
 
-    # ------------------------------------
-    # Set up schedules, variable and fixed
-    
-    # Schedule constant over 24 hours, representing a fixed leak
-    # Currently set to reflect the fact that we turn the system on and off daily to minimize the leak...
+    if args.exportCsv:
+        if not args.resultsDb:
+            parser.error('--exportCsv needs --resultsDb')
+        store = rs.resultsStore(args.resultsDb)
+        store.exportCsv(args.exportCsv)
+        store.close()
+        sys.exit(0)
+
+    if args.start:
+        runMetrics = mt.metrics(args.metrics, start=args.start, end=args.end)
+        if args.joint:
+            with runMetrics.stage('joint'):
+                jointBackfill(args, dataDir, runMetrics)
+        else:
+            with runMetrics.stage('backfill', nTrials=nTrials):
+                backfill(args, nTrials, dataDir)
+        runMetrics.close()
+        sys.exit(0)
 
-    ConstLeakSched = wm.schedule(3)
-    ConstLeakSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('00:00','%H:%M').time()), 23.95*60.0, 'Const Leak')
-    ConstLeakSched.finalize()
+    if args.date:
+        testDateString = args.date
+    else:
+        testDateString = date.today().isoformat()
 
-    # This is the fixed schedule (except for clock drift) for
-    # the irrigation controller in the rear of the house
+    print(args.date, testDateString)
+    testDate = dt.datetime.strptime(testDateString, '%Y-%m-%d')
 
-    RearSched = wm.schedule(2)
-    if args.oldSched:
-        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('05:30','%H:%M').time()), 10.0, 'Lawn')
-        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('05:40','%H:%M').time()), 15.0, 'Fruit Trees')
-        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('05:55','%H:%M').time()), 5.0, 'Planter')
-        RearSched.finalize()
-    else:
-        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('06:38','%H:%M').time()), 10.0, 'Lawn')
-        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('06:53','%H:%M').time()), 15.0, 'Fruit Trees')
-        RearSched.addZone(dt.datetime.combine(testDate, dt.datetime.strptime('07:08','%H:%M').time()), 5.0, 'Planter')
-        RearSched.finalize()
+    runMetrics = mt.metrics(args.metrics, date=testDateString)
+
+    RearSched, ConstLeakSched = buildSchedules(testDate, args.oldSched)
+
+    hydraDatafile, floDataFile = inputFiles(dataDir, testDateString)
 
     # Read in the Hydrawise schedule for testDate.  NOTE - because it varies with the weather, it may be empty
     #
 
-    hydraDatafile = os.path.join(dataDir, 'Hydrawise', testDateString, 'hydrawise-Watering Time (min).xlsx')
-    HydraSched = ph.loadHydraData(hydraDatafile, 1, checkDate=testDate)
+    with runMetrics.stage('hydrawise'):
+        HydraSched = ph.loadHydraData(hydraDatafile, 1, checkDate=testDate)
 
     # Read in the Flo data
-    floDataFile = os.path.join(dataDir, 'Flo', testDateString, 'total-consumption-last-day.csv')
-    measFlows=pf.loadFloData(floDataFile)
-
-    # Data structure for all flows, both active and inactive
+    with runMetrics.stage('flo'):
+        measFlows=loadFlo(floDataFile, testDateString, args.archive)
 
-    flowData = OrderedDict([('FrontOrangeMesquite',(0, 0)), ('NorthHillside',(0, 0)), ('SouthHillside',(0, 0)), ('EastPlanter',(0, 0)), ('SouthPalm',(0, 0)), ('Lawn',(0, 0)), ('FruitTrees',(0, 0)), ('Planter',(0, 0)), ('ConstLeak',(0, 0))])
     # Construct the model
 
-    model = wm.model()
-
-    if HydraSched is not None:
-        model.addSched(HydraSched)
-    model.addSched(RearSched)
-    model.addSched(ConstLeakSched)
-
-    activeFlowLabels = []
-    for sched in model.schedList:
-        for zone in sched.zoneList:
-            activeFlowLabels.append(zone[2].translate({ord(' '):None}))
-        activeFlowLabels.append('toffset')
-    
+    with runMetrics.stage('model'):
+        model, activeFlowLabels = buildModel(HydraSched, RearSched, ConstLeakSched)
+        guesses = warmGuesses(args.warmStart, model, testDateString, nTrials, args.seed)
 
     # Calculate the flows and print results
 
-    if args.plot:
-        pp=PdfPages('{}.pdf'.format(testDateString))
-
-    resultArr = np.zeros((nTrials, model.nFlows + model.nsched))
-    
-    for n in range(nTrials):
-        result = getZoneFlows(model, measFlows)
+    # a fit of the same data, schedules and options is taken from the cache
+
+    cache = None if args.noCache else fc.fitCache(args.cacheDir, args.cacheSize*2**20)
+    if cache:
+        adaptive = [min(args.minTrials, nTrials), args.tol] if args.adaptive else None
+        key = fc.fitKey(measFlows, model, cacheOptions(nTrials, args.solver, args.seed, adaptive, args.resample, args.margin,
+                                                       args.bootstrap, args.blockLength, args.ci), warmSource(args.warmStart, model, testDateString))
+        cached = cache.load(key)
+        runMetrics.record('cache', key=key, hit=cached is not None)
+    if cache and cached:
+        print('cached fit: ', key)
+        results, fitFlows, meds, mads, flowData, ciData = cached
+        nTrials = len(results)
+    else:
+        fitFlows = measFlows
+        with runMetrics.stage('trials', solver=args.solver, workers=args.workers):
+            if args.resample:
+                results, fitFlows = multiResTrials(model, measFlows, nTrials, args.resample, method=args.solver, workers=args.workers,
+                                                   seed=args.seed, guesses=guesses, margin=args.margin)
+            elif args.adaptive:
+                results = adaptiveTrials(model, measFlows, min(args.minTrials, nTrials), nTrials, args.tol,
+                                         method=args.solver, workers=args.workers, seed=args.seed, guesses=guesses)
+                print('adaptive: used {} of at most {} trials'.format(len(results), nTrials))
+                nTrials = len(results)
+            else:
+                results = runTrials(model, measFlows, nTrials, method=args.solver, workers=args.workers, seed=args.seed, guesses=guesses)
 
-        resultArr[n, :] = result.x
-        resultArr[n, :-1] *= 60.0  # gps to gpm
+        for (n, result) in enumerate(results):
+            runMetrics.solverStats(n, result)
 
-        if args.print:
-            printResult(result, model, full=False)
-        if args.plot:
-            plotResids(result, model, measFlows, testDateString, pp)
-            plotScheds(result, model, measFlows, testDateString, pp)
+        ciData = None
+        if args.bootstrap:
+            with runMetrics.stage('bootstrap', replicates=args.bootstrap, blockLength=args.blockLength):
+                meds, mads, flowData, ciData = bootstrapSummary(results, model, measFlows, activeFlowLabels, args.bootstrap,
+                                                                args.blockLength, args.ci, args.seed)
+        else:
+            meds, mads, flowData = summarize(makeResultArr(results, model), activeFlowLabels)
 
-    if args.plot:
-        pp.close()
+        if cache:
+            cache.store(key, results, fitFlows, meds, mads, flowData, ciData)
 
     if args.print:
-        print(resultArr)
+        for result in results:
+            printResult(result, model, full=False)
+        print(makeResultArr(results, model))
 
-    meds = np.median(resultArr, axis=0)
-    mads = mad(resultArr, axis=0)
+    if args.plot or args.report:
+        with runMetrics.stage('plot'):
+            if args.plot:
+                from matplotlib.backends.backend_pdf import PdfPages
+                pp=PdfPages('{}.pdf'.format(testDateString))
+                for result in results:
+                    plotResids(result, model, fitFlows, testDateString, pp)
+                    plotScheds(result, model, fitFlows, testDateString, pp)
+                pp.close()
 
-    for n in range(len(meds)):
-        if flowData.get(activeFlowLabels[n]):
-            flowData[activeFlowLabels[n]] = (meds[n], mads[n])
+            if args.report:
+                plotSummary(results, model, measFlows, testDateString, '{}-summary.pdf'.format(testDateString))
 
     if args.updateSheet:
-        updateSheet(testDate.timestamp(), flowData)
+        with runMetrics.stage('sheet'):
+            updateSheet([(testDate.timestamp(), flowData)], args.sheetsUrl)
+
+    with runMetrics.stage('output'):
+        if args.warmStart:
+            cache = ws.warmStartCache(args.warmStart)
+            cache.store(testDateString, ws.paramLabels(model), medianSolution(results))
+            cache.save()
+
+        if args.resultsDb:
+            store = rs.resultsStore(args.resultsDb)
+            toffsets = rs.toffsetsFromSolution(ws.paramLabels(model), medianSolution(results))
+            store.upsert(testDateString, testDate.timestamp(), flowData, toffsets, nTrials, ciData)
+            store.close()
         
-    if args.dataOut:
-        # check for existence.  if exists just append line.  if not, put out header line first
-        if os.path.exists(args.dataOut):
-            df = open(args.dataOut,'a')
-        else:
-            df = open(args.dataOut,'w')
-            if args.csv:
-                print('time', end=', ', file=df)
-                for (n, label) in enumerate(flowData):
-                    if n == len(flowData) - 1:
-                        endstr = ''
-                    else:
-                        endstr = ', '
-                    print(label, ', ', 'sigma_'+label, end=endstr, file=df)
-            else:
-                print('# time', end=' ', file=df)
-                for label in flowData:
-                    print(label, ' ', 'sigma_'+label, end=' ', file=df)
-            print('', file=df)
-        if args.csv:
-            print(testDate.timestamp(), end=', ', file=df)
+        if args.dataOut:
+            writeDataOut(args.dataOut, [(testDate.timestamp(), flowData)], csv=args.csv)
         else:
-            print(testDate.timestamp(), end=' ', file=df)
-
-        for (n, flow) in enumerate(flowData):
-            median, sigma = flowData[flow]
-            # if csv and last item, endstr = '', else endstr = ', '
-            if args.csv:
-                if n == len(flowData) - 1:
-                    endstr = ''
-                else:
-                    endstr = ', '
-                print('{:.3f}, {:.3f}'.format(median, sigma), end=endstr, file=df)
-            else:
-                print('{:.3f} {:.3f}'.format(median, sigma), end=' ', file=df)
-        print('', file=df)
-        df.close()
-    else:
-        for n in range(len(meds)):
-            print(activeFlowLabels[n], meds[n], mads[n])
-
-        
-        
-
-    
-
-
-
-
+            for n in range(len(meds)):
+                print(activeFlowLabels[n], meds[n], mads[n])
+            if args.bootstrap:
+                print('{:.0f}% intervals:'.format(100.0*args.ci))
+                for label in ciData:
+                    if flowData[label] != (0, 0):
+                        print(label, ciData[label][0], ciData[label][1])
+
+    runMetrics.close()
@@ -0,0 +1,99 @@
+"""
+Cache of daily fits, keyed by a sha256 of everything that determines the fit: the Flo data, the
+schedules as loaded (Hydrawise, rear and constant leak), the warm-start solution the initial
+guesses come from if any, and the solver options including the seed.  Each entry is an .npz
+file holding the trials' solutions and residuals and the day's summary, so a re-run of an
+unchanged day (a cron retry, a new plot, a backfill over old days) skips the fit.  The
+directory is kept under a size limit by deleting the least recently used entries; a hit
+touches its file's mtime.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+from collections import OrderedDict
+from scipy.optimize import OptimizeResult
+
+CACHE_DIR = 'fitCache'  # ChristieDrModel keeps it under the data directory
+CACHE_VERSION = 1  # bump when a change to the model or solvers changes the results
+
+def fitKey(flowMeasurements, flowModel, options, warmSolution=None):
+    h = hashlib.sha256()
+    h.update(json.dumps(OrderedDict([('version', CACHE_VERSION), ('options', options)]), sort_keys=True).encode())
+    h.update(np.ascontiguousarray(flowMeasurements, dtype=np.float64).tobytes())
+    for sched in flowModel.schedList:
+        h.update(json.dumps([sched.id, sched.zoneNames]).encode())
+        h.update(np.ascontiguousarray(sched.times).tobytes())
+        h.update(np.ascontiguousarray(sched.runZone, dtype=np.int64).tobytes())
+    if warmSolution is not None:
+        h.update(np.ascontiguousarray(warmSolution, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+def flowDataJson(flowData):
+    # json text of a flowData; the (0, 0) of a zone that didn't run stays integer, as written by writeDataOut
+    return json.dumps([[label, [v if isinstance(v, int) else float(v) for v in flowData[label]]] for label in flowData])
+
+def flowDataFrom(text):
+    return OrderedDict((label, tuple(values)) for (label, values) in json.loads(str(text)))
+
+class fitCache:
+    def __init__(self, directory=CACHE_DIR, maxBytes=200*2**20):
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+    def fileName(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        # (results, fitFlows, meds, mads, flowData, ciData) or None.  The results only have x,
+        # fun and cost; ciData is None unless the fit was bootstrapped
+        fileName = self.fileName(key)
+        try:
+            with np.load(fileName) as entry:
+                entry = dict(entry)
+            os.utime(fileName)
+        except (OSError, ValueError):
+            return None
+
+        results = [OptimizeResult(x=x, fun=fun, cost=float(cost)) for (x, fun, cost) in zip(entry['x'], entry['fun'], entry['cost'])]
+        flowData = flowDataFrom(entry['flowData'])
+        ciData = flowDataFrom(entry['ciData']) if 'ciData' in entry else None
+        return results, entry['fitFlows'], entry['meds'], entry['mads'], flowData, ciData
+
+    def store(self, key, results, fitFlows, meds, mads, flowData, ciData=None):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        arrays = dict(x=np.array([result.x for result in results]), fun=np.array([result.fun for result in results]),
+                      cost=np.array([result.cost for result in results]), fitFlows=np.asarray(fitFlows),
+                      meds=meds, mads=mads, flowData=np.array(flowDataJson(flowData)))
+        if ciData is not None:
+            arrays['ciData'] = np.array(flowDataJson(ciData))
+
+        # written under a temporary name, so a concurrent load never sees half a file
+        tmpName = self.fileName(key) + '.{}.tmp'.format(os.getpid())
+        with open(tmpName, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmpName, self.fileName(key))
+        self.evict()
+
+    def evict(self):
+        # delete the least recently used entries until the directory is within maxBytes
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue  # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for (mtime, size, name) in entries)
+        for (mtime, size, name) in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
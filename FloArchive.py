@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+Archive of all the Flo consumption history in one file: the (time, gallons) rows of every day,
+as from loadFloData, appended as raw float64 pairs and read back through a memory map.  A json
+index next to it records where each date's rows are, and the UTC offsets its local times were
+read with.  Ingesting a data directory only reads the dates the archive doesn't have yet, and the
+ones read under another time zone, whose new rows replace the old.
+
+Days and time ranges come back as views of the memory map, so nothing is read until used and
+nothing is copied -- except for a time range when some earlier date was ingested after a later
+one, in which case the days are put in time order in a new array.
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+from collections import OrderedDict
+import ProcessFloData as pf
+
+FLO_CSV = 'total-consumption-last-day.csv'
+
+class floArchive:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.indexFile = fileName + '.json'
+        self.days = OrderedDict()  # date string -> [first row, end row, first time, last time, utc offsets]
+        self.rows = 0
+        self.inOrder = True  # every day's rows come after the previous day's in time
+        if os.path.exists(self.indexFile):
+            with open(self.indexFile) as f:
+                index = json.load(f, object_pairs_hook=OrderedDict)
+            self.days = index['days']
+            self.rows = index['rows']
+            self.inOrder = index['inOrder']
+        self.openMap()
+
+    def openMap(self):
+        if self.rows > 0:
+            self.data = np.memmap(self.fileName, dtype=np.float64, mode='r', shape=(self.rows, 2))
+        else:
+            self.data = np.zeros((0, 2))
+
+    def dates(self):
+        return sorted(self.days)
+
+    def __contains__(self, dateString):
+        return dateString in self.days
+
+    def current(self, dateString):
+        # whether the date's rows were read under the local time zone there is now
+        day = self.days[dateString]
+        return len(day) > 4 and day[4] == pf.utcOffsets(self.data[day[0]:day[1], 0])
+
+    def has(self, dateString):
+        # whether the archive has the date's rows as loadFloData would read them now
+        return dateString in self.days and self.current(dateString)
+
+    def append(self, dateString, flowMeasurements):
+        # add a day's rows, or replace them: the old ones are left unindexed.  Anything past the
+        # indexed rows (from an append cut short) is dropped
+        flowMeasurements = np.ascontiguousarray(flowMeasurements, dtype=np.float64)
+        with open(self.fileName, 'ab') as f:
+            f.truncate(self.rows*16)
+            f.write(flowMeasurements.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        start = self.rows
+        self.rows += len(flowMeasurements)
+        if dateString in self.days:
+            self.inOrder = False  # the rows of the whole file are no longer all indexed
+        if len(flowMeasurements) > 0:
+            t0 = float(flowMeasurements[0, 0])
+            t1 = float(flowMeasurements[-1, 0])
+            lastTimes = [day[3] for day in self.days.values() if day[1] > day[0]]
+            if lastTimes and t0 < max(lastTimes):
+                self.inOrder = False
+        else:
+            t0 = t1 = None
+        self.days[dateString] = [start, self.rows, t0, t1, pf.utcOffsets(flowMeasurements[:, 0])]
+        self.saveIndex()
+        self.openMap()
+
+    def saveIndex(self):
+        tmpName = self.indexFile + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump(OrderedDict([('rows', self.rows), ('inOrder', self.inOrder), ('days', self.days)]), f, indent=1)
+        os.replace(tmpName, self.indexFile)
+
+    def ingest(self, dataDir):
+        # append every date under dataDir/Flo that isn't in the archive yet, or was read under
+        # another time zone, in date order.  Returns the dates added
+        floDir = os.path.join(dataDir, 'Flo')
+        added = []
+        for dateString in sorted(os.listdir(floDir)) if os.path.isdir(floDir) else []:
+            floDataFile = os.path.join(floDir, dateString, FLO_CSV)
+            if self.has(dateString) or not os.path.exists(floDataFile):
+                continue
+            self.append(dateString, pf.loadFloData(floDataFile))
+            added.append(dateString)
+        return added
+
+    def day(self, dateString):
+        # the date's rows, as loadFloData would return them from its csv
+        day = self.days[dateString]
+        return self.data[day[0]:day[1]]
+
+    def between(self, tStart, tEnd):
+        # rows with tStart <= time < tEnd
+        if self.inOrder:
+            times = self.data[:, 0]
+            return self.data[np.searchsorted(times, tStart):np.searchsorted(times, tEnd)]
+
+        days = sorted((day for day in self.days.values() if day[1] > day[0] and day[3] >= tStart and day[2] < tEnd),
+                      key=lambda day: day[2])
+        if not days:
+            return np.zeros((0, 2))
+        rows = np.vstack([self.data[day[0]:day[1]] for day in days])
+        return rows[(rows[:, 0] >= tStart) & (rows[:, 0] < tEnd)]
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--archive', help = 'archive file (its index is the same name plus .json)', required=True)
+    parser.add_argument('--dataDir', help = 'directory root for Flo and Hydrawise data', default = '/home/tsa/Dropbox/WaterUsageData')
+    args = parser.parse_args()
+
+    archive = floArchive(args.archive)
+    added = archive.ingest(args.dataDir)
+    print('added {} days; {} days, {} rows in {}'.format(len(added), len(archive.days), archive.rows, args.archive))
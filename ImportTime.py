@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Import-time report for the modules the cron jobs load.  Each module is imported in a fresh
+interpreter; the time reported is the best of several runs, less the startup time of an
+interpreter that imports nothing.  Also checks that none of the slow plotting/Google/stats
+packages get imported along the way.  With --baseline, exits non-zero if any module got
+slower than --tolerance times its baseline time, or pulled in one of those packages.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+MODULES = ['WaterModel', 'ProcessFloData', 'ProcessHydrawiseData', 'ChristieDrModel']
+
+# only needed with --plot or --updateSheet
+HEAVY = ['matplotlib', 'googleapiclient', 'google_auth_oauthlib', 'scipy.stats']
+
+def runTime(code, repeats):
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = float('inf')
+    for n in range(repeats):
+        t0 = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', code], cwd=here)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def heavyImports(module):
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = 'import sys, json, {}; print(json.dumps([m for m in {} if m in sys.modules]))'.format(module, HEAVY)
+    return json.loads(subprocess.check_output([sys.executable, '-c', code], cwd=here).decode())
+
+def importReport(repeats=5):
+    startup = runTime('pass', repeats)
+    report = OrderedDict()
+    for module in MODULES:
+        report[module] = OrderedDict([('seconds', runTime('import ' + module, repeats) - startup),
+                                      ('heavy', heavyImports(module))])
+    return report
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', help = 'imports per module; the best time is reported (default 5)', type=int, default=5)
+    parser.add_argument('--baseline', help = 'json file of baseline import times to check against')
+    parser.add_argument('--save', help = 'write this run to the --baseline file instead of checking', action='store_true')
+    parser.add_argument('--tolerance', help = 'allowed slowdown factor over the baseline (default 1.5)', type=float, default=1.5)
+    args = parser.parse_args()
+
+    report = importReport(args.repeats)
+
+    failed = False
+    baseline = {}
+    if args.baseline and not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    for module in report:
+        seconds = report[module]['seconds']
+        line = '{:24s} {:7.3f} s'.format(module, seconds)
+        if module in baseline:
+            line += '   baseline {:7.3f} s'.format(baseline[module]['seconds'])
+            if seconds > args.tolerance * baseline[module]['seconds']:
+                line += '   SLOWER'
+                failed = True
+        if report[module]['heavy']:
+            line += '   imports ' + ', '.join(report[module]['heavy'])
+            failed = True
+        print(line)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,123 @@
+"""
+Joint fit of several days: each zone's flow is one parameter shared by every day it ran, while
+the toffsets (and, unless shareLeak, the constant leak) are fit per day.  The residuals of all
+the days are stacked and solved together by least_squares with a sparse jacobian and the lsmr
+trust-region solver, so a month of minute data never needs a dense design matrix.
+"""
+import numpy as np
+from collections import OrderedDict
+from scipy.optimize import least_squares as lsq
+from scipy.optimize import lsq_linear
+from scipy.sparse import coo_matrix, vstack
+import WaterModel as wm
+import WarmStart as ws
+
+LEAK_LABEL = '3:ConstLeak'
+
+class jointModel:
+    def __init__(self, shareLeak=False):
+        self.shareLeak = shareLeak
+        self.days = []          # (dateString, model, flowMeasurements, column of each model parameter)
+        self.labels = []        # label of each joint parameter
+        self.index = {}         # label -> joint column
+        self.isToffset = []
+        self.lowerBounds = []
+        self.upperBounds = []
+
+    def column(self, label, lower, upper):
+        if label not in self.index:
+            self.index[label] = len(self.labels)
+            self.labels.append(label)
+            self.isToffset.append(label.endswith(':toffset'))
+            self.lowerBounds.append(lower)
+            self.upperBounds.append(upper)
+        return self.index[label]
+
+    def addDay(self, dateString, flowModel, flowMeasurements):
+        # zone flows are shared by label; toffsets, and the leak unless shareLeak, are labelled by date
+        cols = []
+        for (j, label) in enumerate(ws.paramLabels(flowModel)):
+            if label.endswith(':toffset') or (label == LEAK_LABEL and not self.shareLeak):
+                label = '{}/{}'.format(dateString, label)
+            cols.append(self.column(label, flowModel.lowerBounds[j], flowModel.upperBounds[j]))
+        self.days.append((dateString, flowModel, flowMeasurements, np.array(cols, dtype=int)))
+
+    def nParams(self):
+        return len(self.labels)
+
+    def bounds(self):
+        return np.array(self.lowerBounds), np.array(self.upperBounds)
+
+    def stackedJacobian(self, x, flowsOnly=False):
+        # the days' sparse jacobians stacked, with their columns moved to the joint parameters.
+        # flowsOnly leaves out the toffset columns, giving the design: the prediction is
+        # stackedJacobian(x, True) dotted with x
+        isToffset = np.array(self.isToffset)
+        jacs = []
+        for (dateString, flowModel, flowMeasurements, cols) in self.days:
+            jac = flowModel.sparseJacobian(x[cols], flowMeasurements[:,0]).tocoo()
+            keep = ~isToffset[cols[jac.col]] if flowsOnly else slice(None)
+            jacs.append(coo_matrix((jac.data[keep], (jac.row[keep], cols[jac.col[keep]])), shape=(jac.shape[0], self.nParams())))
+        return vstack(jacs).tocsr()
+
+    def measurements(self):
+        return np.hstack([flowMeasurements[:,1] for (d, m, flowMeasurements, c) in self.days])
+
+    def resids(self, x):
+        return self.measurements() - self.stackedJacobian(x, flowsOnly=True).dot(x)
+
+    def jacobian(self, x):
+        # of the residuals
+        return -self.stackedJacobian(x)
+
+    def initialGuess(self, toffsets=None):
+        # per-day toffsets from searchToffsets (or as given, label -> sec), then every flow
+        # from one bounded linear solve of the joint design at those toffsets
+        x = np.zeros(self.nParams())
+        for (dateString, flowModel, flowMeasurements, cols) in self.days:
+            iOff = flowModel.toffsetIndex()
+            if toffsets is None:
+                x[cols[iOff]] = wm.searchToffsets(flowModel, flowMeasurements)
+            else:
+                x[cols[iOff]] = [toffsets.get(self.labels[c], 0.0) for c in cols[iOff]]
+
+        isToffset = np.array(self.isToffset)
+        A = self.stackedJacobian(x, flowsOnly=True)[:, np.nonzero(~isToffset)[0]]
+        sol = lsq_linear(A, self.measurements(), bounds=(0, np.inf), lsmr_tol='auto')
+        x[~isToffset] = sol.x
+        return x
+
+def jointFit(joint, x0=None, fScale=1.0):
+    # returns the least_squares result, with sigma (per-parameter standard errors from the
+    # jacobian at the solution) added
+    if x0 is None:
+        x0 = joint.initialGuess()
+    lower, upper = joint.bounds()
+    x0 = np.clip(x0, lower, upper)
+    result = lsq(joint.resids, x0, jac=joint.jacobian, bounds=(lower, upper), loss='huber', f_scale=fScale,
+                 tr_solver='lsmr', x_scale='jac')
+
+    # covariance of the parameters: the normal matrix has one row per parameter, so it is small
+    # even when the jacobian isn't
+    J = joint.jacobian(result.x)
+    normal = (J.T.dot(J)).toarray()
+    dof = max(J.shape[0] - J.shape[1], 1)
+    variance = np.sum(joint.resids(result.x)**2)/dof
+    result.sigma = np.sqrt(np.abs(np.diag(np.linalg.pinv(normal)))*variance)
+    return result
+
+def dayFlowData(joint, result, flowData):
+    # per-day (flow, sigma) in gal/min, filled into flowData (as from newFlowData) by zone label,
+    # for each day that was fit.  Returns a list of (dateString, flowData, toffsets)
+    rows = []
+    for (dateString, flowModel, flowMeasurements, cols) in joint.days:
+        dayData = OrderedDict(flowData)
+        toffsets = OrderedDict()
+        for (label, c) in zip(ws.paramLabels(flowModel), cols):
+            schedId, name = label.split(':', 1)
+            if name == 'toffset':
+                toffsets['toffset_' + schedId] = float(result.x[c])
+            elif name in dayData:
+                dayData[name] = (60.0*result.x[c], 60.0*result.sigma[c])
+        rows.append((dateString, dayData, toffsets))
+    return rows
@@ -0,0 +1,73 @@
+"""
+Structured run metrics: stage timings and solver statistics, appended as json lines to a file.
+With no file every call returns straight away, so instrumented code costs next to nothing
+when metrics are off.
+"""
+import json
+import time
+from collections import OrderedDict
+
+class nullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+NULL_STAGE = nullStage()
+
+class timedStage:
+    def __init__(self, owner, name, fields):
+        self.owner = owner
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.owner.record('stage', stage=self.name, seconds=time.perf_counter() - self.t0,
+                          ok=excType is None, **self.fields)
+        return False
+
+class metrics:
+    def __init__(self, fileName=None, **context):
+        # context (e.g. the date being fit) is added to every record
+        self.enabled = fileName is not None
+        self.context = context
+        self.file = open(fileName, 'a') if self.enabled else None
+
+    def stage(self, name, **fields):
+        # with metrics.stage('flo'): ... records how long the block took
+        if not self.enabled:
+            return NULL_STAGE
+        return timedStage(self, name, fields)
+
+    def record(self, event, **fields):
+        if not self.enabled:
+            return
+        entry = OrderedDict([('time', time.time()), ('event', event)])
+        entry.update(self.context)
+        entry.update(fields)
+        print(json.dumps(entry, default=jsonValue), file=self.file)
+        self.file.flush()
+
+    def solverStats(self, trial, result):
+        # statistics of one least_squares (or findFlowsBatch) result
+        if not self.enabled:
+            return
+        self.record('trial', trial=trial, seconds=result.get('seconds'), nfev=result.get('nfev'),
+                    njev=result.get('njev'), status=result.get('status'), cost=result.get('cost'),
+                    nOptFunc=result.get('nOptFunc'))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def jsonValue(value):
+    # numpy scalars
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('{} is not JSON serializable'.format(type(value)))
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""
+Daily pipeline: fetch the day's Flo and Hydrawise data concurrently, wait until both input
+files are there and readable, then run the fit and its outputs (ChristieDrModel.py).  Replaces
+the separate GetFlo, GetHydrawise and ChristieDrModel cron entries.
+
+Each fetch runs in a child process under a timeout and is retried with a growing delay.  A
+fetch that times out is killed, along with the browser it started, before the retry, so two
+attempts never download into the same directory.  A fetcher is any callable taking the
+destination directory; the default ones drive the browser downloads of GetFlo.py and
+GetHydrawise.py, and copyFetcher stands in for them with local files, e.g. for testing.  Inputs
+that are already there and valid aren't fetched again, so a re-run after a failure only redoes
+what failed.
+"""
+
+import argparse
+import asyncio
+import datetime as dt
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+import ChristieDrModel as cdm
+import Metrics as mt
+import ProcessFloData as pf
+import ProcessHydrawiseData as ph
+
+def floFetcher(destDir):
+    from GetFlo import getFloData  # selenium is only needed for the real downloads
+    getFloData(destDir)
+
+def waitForDownload(fileName, timeout=120.0, poll=1.0):
+    # the browser is still saving when the download call returns: wait until the file is there,
+    # no partial download (.part, .crdownload) is left in its directory, and its size has held
+    # for a poll
+    destDir = os.path.dirname(fileName)
+    t0 = time.perf_counter()
+    lastSize = None
+    while time.perf_counter() - t0 < timeout:
+        partial = [name for name in os.listdir(destDir) if name.endswith(('.part', '.crdownload'))]
+        size = os.path.getsize(fileName) if os.path.exists(fileName) else None
+        if not partial and size and size == lastSize:
+            return
+        lastSize = size
+        time.sleep(poll)
+    raise IOError('no finished download of {} after {:.0f} sec'.format(os.path.basename(fileName), timeout))
+
+def hydrawiseFetcher(destDir):
+    from GetHydrawise import getHydrawiseData
+    getHydrawiseData(destDir)
+    # convert .xls from Hydrawise to .xlsx for ProcessHydrawiseData, once it is all there
+    xlsFile = os.path.join(destDir, 'hydrawise-Watering Time (min).xls')
+    waitForDownload(xlsFile)
+    subprocess.check_call(['libreoffice', '-env:UserInstallation=file:///tmp/LibO_Conversion', '--headless', '--invisible',
+                           '--convert-to', 'xlsx', xlsFile, '--outdir', destDir])
+
+class copyFetcher:
+    # copies a local file into the destination directory under the given name, after delay sec
+    def __init__(self, sourceFile, fileName, delay=0.0):
+        self.sourceFile = sourceFile
+        self.fileName = fileName
+        self.delay = delay
+
+    def __call__(self, destDir):
+        time.sleep(self.delay)
+        shutil.copy(self.sourceFile, os.path.join(destDir, self.fileName))
+
+def fetchProcess(fetcher, destDir):
+    # child process of runFetcher: lead a new process group, so the browser goes with us when killed
+    os.setpgrp()
+    fetcher(destDir)
+
+async def runFetcher(fetcher, destDir, timeout, poll=0.5):
+    # fetcher(destDir) in a child process, killed with everything it started if it takes longer
+    # than timeout sec.  Returns None on success, otherwise what went wrong.  The child is
+    # started from the event loop's thread (a child forked from an executor thread fails on
+    # exit) and polled, so the other input's fetch goes on meanwhile
+    process = multiprocessing.Process(target=fetchProcess, args=(fetcher, destDir))
+    process.start()
+    t0 = time.perf_counter()
+    while process.is_alive() and time.perf_counter() - t0 < timeout:
+        await asyncio.sleep(poll)
+    if process.is_alive():
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+            except OSError:
+                pass  # already gone
+            process.join(5.0)
+            if not process.is_alive():
+                break
+        return 'timed out after {:.0f} sec'.format(timeout)
+    process.join()
+    if process.exitcode != 0:
+        return 'fetcher exited with status {}'.format(process.exitcode)
+    return None
+
+def validFlo(fileName):
+    try:
+        return len(pf.parseFloData(fileName)) > 0
+    except Exception:
+        return False
+
+def validHydrawise(fileName):
+    # an empty schedule is valid; an unreadable or half-written workbook isn't
+    try:
+        ph.readHydraIndex(fileName)
+        return True
+    except Exception:
+        return False
+
+def log(message):
+    print('{} {}'.format(dt.datetime.now().strftime('%H:%M:%S'), message))
+    sys.stdout.flush()
+
+async def waitForInput(fileName, validate, timeout, poll=2.0):
+    # the browser saves downloads after the fetcher returns, so poll for the file
+    t0 = time.perf_counter()
+    while True:
+        if os.path.exists(fileName) and validate(fileName):
+            return True
+        if time.perf_counter() - t0 >= timeout:
+            return False
+        await asyncio.sleep(poll)
+
+async def fetchInput(name, fetcher, fileName, validate, timeout=300.0, waitTimeout=120.0, retries=3, delay=30.0,
+                     refetch=False, metrics=None, loop=None):
+    # fetch one input until it is valid, trying up to retries times.  Returns True on success
+    loop = loop or asyncio.get_event_loop()
+    metrics = metrics or mt.metrics()
+    if not refetch and os.path.exists(fileName) and validate(fileName):
+        log('{}: have {}'.format(name, fileName))
+        return True
+
+    destDir = os.path.dirname(fileName)
+    os.makedirs(destDir, exist_ok=True)
+    for attempt in range(retries):
+        t0 = time.perf_counter()
+        try:
+            error = await runFetcher(fetcher, destDir, timeout)
+            if error is None and not await waitForInput(fileName, validate, waitTimeout):
+                error = 'no valid {} after {:.0f} sec'.format(os.path.basename(fileName), waitTimeout)
+        except Exception as e:
+            error = repr(e)
+        seconds = time.perf_counter() - t0
+        metrics.record('fetch', step=name, attempt=attempt+1, seconds=seconds, ok=error is None, error=error)
+        if error is None:
+            log('{}: fetched in {:.1f} sec'.format(name, seconds))
+            return True
+        log('{}: attempt {} of {} failed in {:.1f} sec: {}'.format(name, attempt+1, retries, seconds, error))
+        if attempt < retries - 1:
+            await asyncio.sleep(delay * 2**attempt)
+    return False
+
+def fitCommand(dateString, dataDir, fitArgs):
+    here = os.path.dirname(os.path.abspath(__file__))
+    return [sys.executable, os.path.join(here, 'ChristieDrModel.py'), '--date', dateString, '--dataDir', dataDir] + fitArgs
+
+async def runPipeline(dateString, dataDir, fetchers, fitArgs=(), timeout=300.0, waitTimeout=120.0, retries=3, delay=30.0,
+                      refetch=False, metrics=None, loop=None):
+    # fetchers maps 'flo' and 'hydrawise' to fetcher callables.  Returns the exit status: 0 when
+    # the fit ran and succeeded
+    loop = loop or asyncio.get_event_loop()
+    metrics = metrics or mt.metrics()
+    hydraDatafile, floDataFile = cdm.inputFiles(dataDir, dateString)
+    steps = OrderedDict()
+
+    t0 = time.perf_counter()
+    with metrics.stage('fetch'):
+        fetched = await asyncio.gather(
+            fetchInput('flo', fetchers['flo'], floDataFile, validFlo, timeout, waitTimeout, retries, delay, refetch, metrics, loop),
+            fetchInput('hydrawise', fetchers['hydrawise'], hydraDatafile, validHydrawise, timeout, waitTimeout, retries, delay, refetch, metrics, loop))
+    steps['fetch'] = time.perf_counter() - t0
+
+    if not all(fetched):
+        log('missing inputs ({}), not fitting'.format(', '.join(name for (name, ok) in zip(['flo', 'hydrawise'], fetched) if not ok)))
+        status = 1
+    else:
+        t0 = time.perf_counter()
+        with metrics.stage('fit'):
+            status = await loop.run_in_executor(None, subprocess.call, fitCommand(dateString, dataDir, list(fitArgs)))
+        steps['fit'] = time.perf_counter() - t0
+        log('fit: exit status {}'.format(status))
+
+    for step in steps:
+        log('{}: {:.1f} sec'.format(step, steps[step]))
+    return status
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Fetch the day\'s data and fit it; arguments after -- go to ChristieDrModel.py')
+    parser.add_argument('--date', help = 'date as 20yy-mm-dd (default today)')
+    parser.add_argument('--dataDir', help = 'directory root for Flo and Hydrawise data', default = '/home/tsa/Dropbox/WaterUsageData')
+    parser.add_argument('--timeout', help = 'seconds allowed for each fetch (default 300)', type=float, default=300.0)
+    parser.add_argument('--waitTimeout', help = 'seconds to wait after a fetch for its file to be valid (default 120)', type=float, default=120.0)
+    parser.add_argument('--retries', help = 'tries per fetch (default 3)', type=int, default=3)
+    parser.add_argument('--delay', help = 'seconds before the first retry, doubling after each (default 30)', type=float, default=30.0)
+    parser.add_argument('--refetch', help = 'fetch even if the day\'s input files are already there', action='store_true')
+    parser.add_argument('--floFrom', help = 'copy this Flo csv instead of downloading it')
+    parser.add_argument('--hydraFrom', help = 'copy this Hydrawise xlsx instead of downloading it')
+    parser.add_argument('--metrics', help = 'append step timings to this json-lines file')
+    parser.add_argument('fitArgs', nargs=argparse.REMAINDER, help = 'arguments for ChristieDrModel.py, after --')
+    args = parser.parse_args()
+
+    dateString = args.date if args.date else dt.date.today().isoformat()
+    hydraDatafile, floDataFile = cdm.inputFiles(args.dataDir, dateString)
+    fetchers = {'flo': floFetcher, 'hydrawise': hydrawiseFetcher}
+    if args.floFrom:
+        fetchers['flo'] = copyFetcher(args.floFrom, os.path.basename(floDataFile))
+    if args.hydraFrom:
+        fetchers['hydrawise'] = copyFetcher(args.hydraFrom, os.path.basename(hydraDatafile))
+    fitArgs = args.fitArgs[1:] if args.fitArgs[:1] == ['--'] else args.fitArgs
+
+    metrics = mt.metrics(args.metrics, date=dateString)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        status = loop.run_until_complete(runPipeline(dateString, args.dataDir, fetchers, fitArgs, args.timeout, args.waitTimeout,
+                                                     args.retries, args.delay, args.refetch, metrics, loop))
+    finally:
+        loop.close()
+        metrics.close()
+    sys.exit(status)
@@ -1,33 +1,85 @@
 import numpy as np
-import re
+import os
+import time
 from datetime import datetime
 
-def loadFloData(inputFileName):
-    marker = re.compile('Gallons')
-    
-    d = np.loadtxt(inputFileName, delimiter=',', dtype=str)
-    nrows = d.shape[0]
-
-    first = True
-    for n in range(nrows):
-        d[n,0] = d[n,0].translate({ord('"'):None})
-        d[n,1] = d[n,1].translate({ord('"'):None})
-        if marker.match(d[n,1]):
-            if first:
-                marker0 = n+1
-                first = False
-            else:
-                marker1 = n-1
-
-    dtoday = d[marker0:marker1,:]
-
-    decoded = np.zeros_like(dtoday, dtype=float)
-
-    timeFormat = "%m/%d/%Y %I:%M %p"
-    
-    for (i, row) in enumerate(dtoday):
-        decoded[i,0] = datetime.strptime(row[0], timeFormat).timestamp()
-        decoded[i,1] = float(row[1])
+# The consumption export has several sections, each introduced by a row whose second column is
+# 'Gallons'.  The day's data runs from the row after the first marker to two rows before the last.
+#
+# Parsing is a single pass over the lines, and the parsed (time, gallons) array is kept in a .npy
+# sidecar next to the csv.  Its first row holds the csv's mtime and size, and its second the UTC
+# offsets the export's local times were read with, so the csv is only parsed again if it changes,
+# if the local time zone has changed since, or if the sidecar can't be read (it is then written
+# again).
+
+timeFormat = "%m/%d/%Y %I:%M %p"
+
+def cacheFileName(inputFileName):
+    return os.path.splitext(inputFileName)[0] + '.npy'
+
+def decodeTimes(timeStrings):
+    # strptime once per distinct date and hour rather than once per row; the minutes are added on.
+    # Rows look like '07/01/2019 12:05 AM', so the minutes are always timeString[-5:-3]
+    hourKeys = [s[:-6] + ':00' + s[-3:] for s in timeStrings]
+    uniqueKeys, inverse = np.unique(hourKeys, return_inverse=True)
+    hourStarts = np.array([datetime.strptime(key, timeFormat).timestamp() for key in uniqueKeys])
+    minutes = np.array([s[-5:-3] for s in timeStrings], dtype=float)
+    return hourStarts[inverse] + 60.0*minutes
+
+def utcOffsets(times):
+    # the local UTC offsets at the first and last of times, which epochs parsed from local times depend on
+    if len(times) == 0:
+        return [0.0, 0.0]
+    return [float(time.localtime(t).tm_gmtoff) for t in (times[0], times[-1])]
+
+def parseFloData(inputFileName):
+    timeStrings = []
+    gallonStrings = []
+    markers = []
+    with open(inputFileName) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.replace('"', '').split(',')
+            if fields[1].startswith('Gallons'):
+                markers.append(len(timeStrings))
+            timeStrings.append(fields[0].strip())
+            gallonStrings.append(fields[1].strip())
+
+    marker0 = markers[0] + 1
+    marker1 = markers[-1] - 1
+
+    decoded = np.zeros((len(timeStrings[marker0:marker1]), 2))
+    if len(decoded) > 0:
+        decoded[:,0] = decodeTimes(timeStrings[marker0:marker1])
+        decoded[:,1] = np.array(gallonStrings[marker0:marker1], dtype=float)
+
+    return decoded
+
+def loadFloData(inputFileName, useCache=True):
+    stat = os.stat(inputFileName)
+    cacheFile = cacheFileName(inputFileName)
+
+    if useCache and os.path.exists(cacheFile):
+        try:
+            cached = np.load(cacheFile)
+            if (cached.ndim == 2 and cached.shape[0] > 1 and cached[0,0] == stat.st_mtime and cached[0,1] == stat.st_size
+                    and list(cached[1]) == utcOffsets(cached[2:,0])):
+                return cached[2:]
+        except (OSError, ValueError, EOFError):
+            pass  # e.g. cut short by a crash; parse the csv and write it again
+
+    decoded = parseFloData(inputFileName)
+
+    if useCache:
+        # written under a temporary name, so a concurrent load never sees half a file
+        tmpName = cacheFile + '.{}.tmp'.format(os.getpid())
+        try:
+            with open(tmpName, 'wb') as f:
+                np.save(f, np.vstack(([stat.st_mtime, stat.st_size], utcOffsets(decoded[:,0]), decoded)))
+            os.replace(tmpName, cacheFile)
+        except OSError:
+            pass  # e.g. a read-only data directory; just parse again next time
 
     return decoded
-    
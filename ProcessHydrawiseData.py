@@ -1,44 +1,93 @@
 """
 Read in .xlsx schedule data downloaded from Hydrawise.  Return it as a Schedule
+
+The workbook is read once, in read-only mode, into an index of zone -> date -> [(start, duration)],
+which is pickled next to the .xlsx.  Schedules for any number of dates then come from the index
+without reopening the workbook, until the .xlsx's mtime or size changes or the index can't be read.
 """
 import numpy as np
 import datetime
-from openpyxl import load_workbook
+import os
+import pickle
+from collections import OrderedDict
 from WaterModel import schedule
 
 # spreadsheet may be empty.  In this case, there is a single sheet, 'Worksheet', and all cells are empty
 
-def loadHydraData(inputFileName, controllerId, checkDate):
-    wb = load_workbook(inputFileName)
-    zoneList = wb.sheetnames
+def indexFileName(inputFileName):
+    return os.path.splitext(inputFileName)[0] + '.pickle'
 
-    sched = schedule(controllerId)
+def readHydraIndex(inputFileName):
+    from openpyxl import load_workbook  # only needed when the cached index is stale
+    wb = load_workbook(inputFileName, read_only=True)
+    hydraIndex = OrderedDict()
 
-    for zone in zoneList:
-        ws = wb[zone]
-        if ws['A1'].value is None:  # check for empty
+    for zone in wb.sheetnames:
+        rows = list(wb[zone].iter_rows(values_only=True))
+        while len(rows) > 0 and all(v is None for v in rows[-1]):  # read-only mode keeps empty rows
+            rows.pop()
+        if len(rows) == 0 or len(rows[0]) == 0 or rows[0][0] is None:  # check for empty
             continue
-        
-        assert(ws['A1'].value == 'Date')
-        assert(ws['B1'].value == 'Time')
-        assert(ws['C1'].value == 'min')
-        
-        for row in range(2, ws.max_row):
-            cellBId = 'B{}'.format(row)
-            cellCId = 'C{}'.format(row)
-            zoneStart = ws[cellBId].value # datetime
-            zoneDuration = ws[cellCId].value  # minutes
+
+        assert(rows[0][0] == 'Date')
+        assert(rows[0][1] == 'Time')
+        assert(rows[0][2] == 'min')
+
+        runs = OrderedDict()
+        for row in rows[1:-1]:  # as always, the sheet's last row is not read
+            zoneStart = row[1] # datetime
+            zoneDuration = row[2]  # minutes
             if zoneStart is None:
                 break
-            if zoneStart.date() == checkDate.date():
-                if zoneDuration > 0:
-                    sched.addZone(zoneStart, zoneDuration, zone)
-                    print('Hydrawise added: ', zoneStart.date(), zoneDuration, zone)
-                break
-            
+            runs.setdefault(zoneStart.date(), []).append((zoneStart, zoneDuration))
+        hydraIndex[zone] = runs
+
+    wb.close()
+
+    return hydraIndex
+
+def loadHydraIndex(inputFileName, useCache=True):
+    stat = os.stat(inputFileName)
+    indexFile = indexFileName(inputFileName)
+
+    if useCache and os.path.exists(indexFile):
+        try:
+            with open(indexFile, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+                return cached['index']
+        except Exception:
+            pass  # e.g. cut short by a crash (EOFError, UnpicklingError); read the workbook and write it again
+
+    hydraIndex = readHydraIndex(inputFileName)
+
+    if useCache:
+        # written under a temporary name, so a concurrent load never sees half a file
+        tmpName = indexFile + '.{}.tmp'.format(os.getpid())
+        try:
+            with open(tmpName, 'wb') as f:
+                pickle.dump({'mtime': stat.st_mtime, 'size': stat.st_size, 'index': hydraIndex}, f)
+            os.replace(tmpName, indexFile)
+        except OSError:
+            pass  # e.g. a read-only data directory; just read the workbook again next time
+
+    return hydraIndex
+
+def hydraSchedule(hydraIndex, controllerId, checkDate):
+    sched = schedule(controllerId)
+
+    for zone in hydraIndex:
+        runs = hydraIndex[zone].get(checkDate.date())
+        if runs is None:
+            continue
+        for (zoneStart, zoneDuration) in runs:  # every run of the zone that day
+            if zoneDuration > 0:
+                sched.addZone(zoneStart, zoneDuration, zone)
+                print('Hydrawise added: ', zoneStart.date(), zoneDuration, zone)
+
     sched.finalize()
 
     return sched
-        
 
-    
+def loadHydraData(inputFileName, controllerId, checkDate, useCache=True):
+    return hydraSchedule(loadHydraIndex(inputFileName, useCache), controllerId, checkDate)
@@ -0,0 +1,58 @@
+"""
+Resampling of the Flo series for coarse-to-fine fitting.  A row of loadFloData output holds the
+gallons used from its time to the next row's, so merging consecutive rows keeps the series in
+the same form and the model's prediction for a merged interval is exactly the sum of its parts.
+
+binFlows merges the rows into bins of a fixed length, for a first fit of the toffsets and flows.
+refineFlows then keeps the native rows near the zone windows' edges, where the fit is decided,
+and merges everything in between (idle stretches, and the steady middles of the windows) into
+intervals of at most idleSeconds.
+"""
+import numpy as np
+
+def collapse(flowMeasurements, keep):
+    # merge each run of rows into the kept row starting it.  keep is a sorted array of row
+    # indices starting at 0; the last row, whose gallons fall after the last time, stays alone
+    n = len(flowMeasurements)
+    keep = np.union1d(keep, [0, n - 1]).astype(int)
+    merged = np.zeros((len(keep), 2))
+    merged[:, 0] = flowMeasurements[keep, 0]
+    merged[:, 1] = np.add.reduceat(flowMeasurements[:, 1], keep)
+    return merged
+
+def binStarts(flowTimes, binSeconds):
+    # first row of each bin of binSeconds, counted from the first time
+    bins = np.floor((flowTimes - flowTimes[0])/binSeconds)
+    return np.nonzero(np.r_[True, bins[1:] != bins[:-1]])[0]
+
+def binFlows(flowMeasurements, binSeconds):
+    return collapse(flowMeasurements, binStarts(flowMeasurements[:, 0], binSeconds))
+
+def windowEdges(flowModel, toffsets):
+    # sorted start and end times of every run, shifted by each schedule's toffset
+    edges = []
+    for (i, sched) in enumerate(flowModel.schedList):
+        sched.setToffset(toffsets[i])
+        t1, t2 = sched.windows()
+        edges += [t1, t2]
+    return np.sort(np.hstack(edges))
+
+def nearEdges(flowTimes, edges, margin):
+    # rows whose time is within margin of an edge
+    if len(edges) == 0:
+        return np.zeros(0, dtype=int)
+    i = np.searchsorted(edges, flowTimes)
+    below = edges[np.maximum(i - 1, 0)]
+    above = edges[np.minimum(i, len(edges) - 1)]
+    distance = np.minimum(np.abs(flowTimes - below), np.abs(flowTimes - above))
+    return np.nonzero(distance <= margin)[0]
+
+def refineFlows(flowModel, flowMeasurements, toffsets, margin=600.0, idleSeconds=3600.0):
+    # native rows within margin of a window edge (at the given toffsets), the rest merged into
+    # intervals of at most idleSeconds
+    flowTimes = flowMeasurements[:, 0]
+    near = nearEdges(flowTimes, windowEdges(flowModel, toffsets), margin)
+    # the row after a near one starts a merged interval, so the near row's interval stays native
+    keep = np.union1d(near, near + 1)
+    keep = np.union1d(keep[keep < len(flowTimes)], binStarts(flowTimes, idleSeconds))
+    return collapse(flowMeasurements, keep)
@@ -0,0 +1,88 @@
+"""
+Date-indexed store of the daily fit results: one row per date in an SQLite table, with the
+median and sigma of each flow in flowData, the median toffset of each schedule and the number
+of trials, and with a bootstrap the low and high ends of each flow's interval.  Re-running a
+date replaces its row.
+"""
+import sqlite3
+import numpy as np
+from collections import OrderedDict
+
+def toffsetsFromSolution(labels, solution):
+    # labels as from WarmStart.paramLabels, '<schedule id>:toffset' for the toffsets
+    toffsets = OrderedDict()
+    for (label, value) in zip(labels, solution):
+        schedId, name = label.split(':', 1)
+        if name == 'toffset':
+            toffsets['toffset_' + schedId] = float(value)
+    return toffsets
+
+class resultsStore:
+    def __init__(self, fileName):
+        self.conn = sqlite3.connect(fileName)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results (date TEXT PRIMARY KEY, time REAL, nTrials INTEGER)')
+        self.conn.commit()
+
+    def columns(self):
+        return [row[1] for row in self.conn.execute('PRAGMA table_info(results)')]
+
+    def addColumns(self, names):
+        existing = set(self.columns())
+        for name in names:
+            if name not in existing:
+                self.conn.execute('ALTER TABLE results ADD COLUMN "{}" REAL'.format(name))
+
+    def upsert(self, dateString, time, flowData, toffsets, nTrials, ciData=None):
+        # ciData, if given, holds each flow's (low, high) interval, as from Bootstrap.intervals
+        row = OrderedDict([('date', dateString), ('time', time), ('nTrials', nTrials)])
+        for label in flowData:
+            median, sigma = flowData[label]
+            row[label] = float(median)
+            row['sigma_' + label] = float(sigma)
+        row.update(toffsets)
+        if ciData is not None:
+            for label in ciData:
+                low, high = ciData[label]
+                row['lo_' + label] = float(low)
+                row['hi_' + label] = float(high)
+
+        self.addColumns(list(row)[3:])
+        names = ', '.join('"{}"'.format(name) for name in row)
+        marks = ', '.join('?' for name in row)
+        self.conn.execute('INSERT OR REPLACE INTO results ({}) VALUES ({})'.format(names, marks), list(row.values()))
+        self.conn.commit()
+
+    def query(self, start=None, end=None):
+        # rows with start <= date <= end (date strings as 20yy-mm-dd, either may be None) in date
+        # order, as a numpy structured array with one field per column; missing values are nan
+        columns = self.columns()
+        sql = 'SELECT * FROM results'
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append('date >= ?')
+            params.append(start)
+        if end is not None:
+            conditions.append('date <= ?')
+            params.append(end)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        rows = self.conn.execute(sql + ' ORDER BY date', params).fetchall()
+
+        dtype = [('date', 'U10'), ('time', float), ('nTrials', int)] + [(name, float) for name in columns[3:]]
+        data = np.zeros(len(rows), dtype=dtype)
+        for (i, row) in enumerate(rows):
+            data[i] = tuple(np.nan if v is None else v for v in row)
+        return data
+
+    def exportCsv(self, fileName, start=None, end=None):
+        data = self.query(start, end)
+        with open(fileName, 'w') as df:
+            print(', '.join(data.dtype.names), file=df)
+            for row in data:
+                values = [row['date'], str(row['time']), str(row['nTrials'])]
+                values += ['{:.3f}'.format(row[name]) for name in data.dtype.names[3:]]
+                print(', '.join(values), file=df)
+
+    def close(self):
+        self.conn.close()
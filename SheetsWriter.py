@@ -0,0 +1,181 @@
+"""
+Append rows to the Google sheet through a local outbox.  Rows are first added to a json-lines
+outbox file, then everything pending is sent with a single append.  Transient failures
+(connection errors, timeouts, HTTP 429 and 5xx) are retried with exponential backoff.  Rows
+stay in the outbox until an append succeeds, so a failed run loses nothing and the next run
+sends them along with its own.  Other failures aren't retried: if the sheet refuses the request
+itself (any other 4xx) the rows are moved to a rejected file, so they don't block the rows
+after them; authentication errors and the like leave them in the outbox for the next run.
+
+The append itself goes through a transport: googleTransport uses the Google API client, and
+restTransport posts to the same REST endpoint at any base url, e.g. a local fake server.
+"""
+import datetime as dt
+import http.client
+import json
+import os
+import pickle
+import socket
+import time as _time
+from urllib.error import URLError
+
+OUTBOX = 'sheetsOutbox.jsonl'
+RANGE_NAME = 'Model Fit'
+
+def sheetRow(time, flowData):
+    valueList = [time]
+    for (n, flow) in enumerate(flowData):
+        median, sigma = flowData[flow]
+        valueList.append(float(median))
+        valueList.append(float(sigma))
+
+    valueList.append(dt.date.fromtimestamp(time).isoformat())
+    return valueList
+
+def queueRows(rows, outbox=OUTBOX):
+    with open(outbox, 'a') as f:
+        for row in rows:
+            print(json.dumps(row), file=f)
+        f.flush()
+        os.fsync(f.fileno())
+
+def pendingRows(outbox=OUTBOX):
+    if not os.path.exists(outbox):
+        return []
+    with open(outbox) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def rejectedFile(outbox=OUTBOX):
+    return os.path.splitext(outbox)[0] + '.rejected.jsonl'
+
+def httpStatus(e):
+    # status of an HTTP error from urllib (code) or the Google API client (resp.status), else None
+    status = getattr(e, 'code', None)
+    if status is None and getattr(e, 'resp', None) is not None:
+        status = getattr(e.resp, 'status', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+def failureKind(e):
+    # 'transient': worth retrying (connection errors, timeouts, 429, 5xx); 'rejected': the sheet
+    # refused the request (other 4xx); 'fatal': anything else, e.g. authentication
+    status = httpStatus(e)
+    if status is not None:
+        if status == 429 or status >= 500:
+            return 'transient'
+        if status in (401, 403):
+            return 'fatal'
+        return 'rejected'
+    if isinstance(e, (ConnectionError, TimeoutError, socket.timeout, URLError, http.client.HTTPException)):
+        return 'transient'
+    return 'fatal'
+
+def removeSent(outbox, nRows):
+    # drop the first nRows, keeping anything queued while we were sending
+    remaining = pendingRows(outbox)[nRows:]
+    tmpName = outbox + '.tmp'
+    with open(tmpName, 'w') as f:
+        for row in remaining:
+            print(json.dumps(row), file=f)
+    os.replace(tmpName, outbox)
+
+def flushOutbox(transport, spreadsheetId, outbox=OUTBOX, rangeName=RANGE_NAME, maxTries=5, delay=2.0, sleep=_time.sleep):
+    # send every pending row with one append.  Returns the number of rows sent; on failure the
+    # rows are left in the outbox (or if rejected, moved to rejectedFile(outbox)) and 0 is returned
+    rows = pendingRows(outbox)
+    if not rows:
+        return 0
+
+    for attempt in range(maxTries):
+        try:
+            transport.append(spreadsheetId, rangeName, rows)
+            break
+        except Exception as e:
+            kind = failureKind(e)
+            print('sheet append failed (attempt {} of {}, {}): {}'.format(attempt+1, maxTries, kind, e))
+            if kind == 'rejected':
+                queueRows(rows, rejectedFile(outbox))
+                removeSent(outbox, len(rows))
+                print('sheet: moved {} rejected rows to {}'.format(len(rows), rejectedFile(outbox)))
+                return 0
+            if kind == 'fatal' or attempt == maxTries - 1:
+                return 0
+            sleep(delay * 2**attempt)
+
+    removeSent(outbox, len(rows))
+
+    return len(rows)
+
+class googleTransport:
+    # first part copied from Google sheet API quickstart.py.  The service is built once and
+    # shared by every googleTransport in the process
+
+    service = None
+
+    def __init__(self, tokenFile='token.pickle', credentialsFile='credentials.json'):
+        self.tokenFile = tokenFile
+        self.credentialsFile = credentialsFile
+
+    def getService(self):
+        if googleTransport.service is not None:
+            return googleTransport.service
+
+        from googleapiclient.discovery import build
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+
+        # If modifying these scopes, delete the file token.pickle.
+        SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+        creds = None
+        # The file token.pickle stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        if os.path.exists(self.tokenFile):
+            with open(self.tokenFile, 'rb') as token:
+                creds = pickle.load(token)
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    self.credentialsFile, SCOPES)
+                creds = flow.run_local_server(port=0)
+            # Save the credentials for the next run
+            with open(self.tokenFile, 'wb') as token:
+                pickle.dump(creds, token)
+
+        googleTransport.service = build('sheets', 'v4', credentials=creds)
+        return googleTransport.service
+
+    def append(self, spreadsheetId, rangeName, rows):
+        body = {
+            'values': rows
+        }
+        self.getService().spreadsheets().values().append(
+            spreadsheetId=spreadsheetId, range=rangeName, insertDataOption='INSERT_ROWS',
+            valueInputOption='USER_ENTERED', body=body).execute()
+
+class restTransport:
+    # the Sheets v4 values.append REST call, against any base url
+
+    def __init__(self, baseUrl, accessToken=None, timeout=30):
+        self.baseUrl = baseUrl.rstrip('/')
+        self.accessToken = accessToken
+        self.timeout = timeout
+
+    def append(self, spreadsheetId, rangeName, rows):
+        from urllib.parse import quote
+        from urllib.request import Request, urlopen
+
+        url = '{}/v4/spreadsheets/{}/values/{}:append?valueInputOption=USER_ENTERED&insertDataOption=INSERT_ROWS'.format(
+            self.baseUrl, quote(spreadsheetId), quote(rangeName))
+        headers = {'Content-Type': 'application/json'}
+        if self.accessToken:
+            headers['Authorization'] = 'Bearer ' + self.accessToken
+        request = Request(url, data=json.dumps({'values': rows}).encode(), headers=headers, method='POST')
+        with urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode())
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Streaming zone-flow estimate: Flo readings are added one at a time (or a few at a time) and the
+zone flows are estimated from running normal equations of the WaterModel design, with the
+toffsets held fixed, e.g. at the last daily fit's.  A sample interval only touches the zones
+whose runs it overlaps, found from each schedule's interval index, so an update costs O(zones)
+at most and never revisits old samples.
+
+The leak rate is tracked separately as an exponentially weighted average over idle intervals,
+where nothing but the constant leak is running.  Intervals within edgeMargin of a run's window
+don't count as idle, so irrigation at the window edges (with the toffsets a little off) doesn't
+look like a leak.  An alert is raised when the average goes past a threshold, and re-armed only
+once it drops below a lower clear level, so a leak near the threshold alerts once, not on every
+crossing.
+"""
+
+import numpy as np
+import datetime as dt
+import argparse
+import os
+
+class streamingEstimator:
+    def __init__(self, flowModel, toffsets=None, leakThreshold=0.1, alpha=0.05, onAlert=None, leakZone=None,
+                 leakClear=None, edgeMargin=300.0):
+        # leakThreshold and leakClear (default 0.8*leakThreshold) in gal/min, alpha the weight of
+        # each idle interval in the leak average, edgeMargin in sec.  leakZone is the column of the
+        # leak among the zone flows; by default the last one, as buildModel adds the constant leak
+        # schedule last
+        self.flowModel = flowModel
+        if toffsets is None:
+            toffsets = np.zeros(flowModel.nsched)
+
+        # zone labels in the order of model.flowIndex(), and the column there of each schedule's first zone
+        self.labels = []
+        self.firstCol = []
+        for (i, sched) in enumerate(flowModel.schedList):
+            sched.setToffset(toffsets[i])
+            self.firstCol.append(len(self.labels))
+            for name in sched.zoneNames:
+                self.labels.append(name.translate({ord(' '):None}))
+        self.leakZone = flowModel.nFlows - 1 if leakZone is None else leakZone
+        # the schedules other than the leak's, whose windows (plus edgeMargin) aren't idle
+        self.runScheds = [sched for (i, sched) in enumerate(flowModel.schedList)
+                          if not self.firstCol[i] <= self.leakZone < self.firstCol[i] + sched.nzones]
+
+        self.normal = np.zeros((flowModel.nFlows, flowModel.nFlows))
+        self.rhs = np.zeros(flowModel.nFlows)
+        self.nSamples = 0
+        self.pending = None  # (time, gallons) of the open interval
+
+        self.leakThreshold = leakThreshold
+        self.leakClear = 0.8*leakThreshold if leakClear is None else leakClear
+        self.edgeMargin = edgeMargin
+        self.alpha = alpha
+        self.onAlert = onAlert
+        self.leakRate = None  # gal/sec
+        self.alerting = False
+
+    def add(self, t, gallons):
+        # a Flo reading: gallons used from t to the next reading's time.  The previous reading's
+        # interval is closed by this one.  Returns True if this reading raised a leak alert
+        alert = False
+        if self.pending is not None:
+            alert = self.update(self.pending[0], t, self.pending[1])
+        self.pending = (t, gallons)
+        return alert
+
+    def addBatch(self, flowMeasurements):
+        # rows of (time, gallons) as from loadFloData
+        alert = False
+        for (t, gallons) in flowMeasurements:
+            alert = self.add(t, gallons) or alert
+        return alert
+
+    def update(self, ta, tb, gallons):
+        # the runs overlapping [ta, tb] come from each schedule's interval index; two runs of a
+        # zone in one interval add up
+        overlaps = {}
+        for (i, sched) in enumerate(self.flowModel.schedList):
+            for r in sched.activeRuns(ta, tb):
+                overlap = min(tb, sched.times[r, 1] + sched.toffset) - max(ta, sched.times[r, 0] + sched.toffset)
+                if overlap > 0:
+                    col = self.firstCol[i] + sched.runZone[r]
+                    overlaps[col] = overlaps.get(col, 0.0) + overlap
+        if not overlaps:
+            return False
+        active = np.array(sorted(overlaps))
+        row = np.array([overlaps[col] for col in active])
+        self.normal[np.ix_(active, active)] += np.outer(row, row)
+        self.rhs[active] += row*gallons
+        self.nSamples += 1
+
+        if len(active) == 1 and active[0] == self.leakZone and tb > ta and self.idle(ta, tb):
+            rate = gallons/(tb - ta)
+            if self.leakRate is None:
+                self.leakRate = rate
+            else:
+                self.leakRate += self.alpha*(rate - self.leakRate)
+            return self.checkLeak(tb)
+        return False
+
+    def idle(self, ta, tb):
+        # no run window within edgeMargin of [ta, tb]
+        for sched in self.runScheds:
+            if len(sched.activeRuns(ta - self.edgeMargin, tb + self.edgeMargin)) > 0:
+                return False
+        return True
+
+    def checkLeak(self, t):
+        # alert once on going past the threshold, re-armed when the leak drops below the clear level
+        leakGpm = 60.0*self.leakRate
+        if leakGpm < self.leakClear:
+            self.alerting = False
+            return False
+        if self.alerting or leakGpm <= self.leakThreshold:
+            return False
+        self.alerting = True
+        if self.onAlert is not None:
+            self.onAlert(t, leakGpm)
+        return True
+
+    def zoneFlows(self):
+        # current estimate (gal/sec) of each zone flow in model.flowIndex() order, from the
+        # zones seen so far; the others are nan.  Negative flows are clipped to zero
+        flows = np.full(self.flowModel.nFlows, np.nan)
+        seen = np.nonzero(np.diag(self.normal) > 0)[0]
+        if len(seen) > 0:
+            sol = np.linalg.lstsq(self.normal[np.ix_(seen, seen)], self.rhs[seen], rcond=None)[0]
+            flows[seen] = np.maximum(sol, 0.0)
+        return flows
+
+    def flowData(self):
+        # label -> gal/min, as in ChristieDrModel's flowData but without a sigma
+        flows = self.zoneFlows()
+        return [(label, 60.0*flow) for (label, flow) in zip(self.labels, flows)]
+
+def printAlert(t, leakGpm):
+    print('{} leak alert: {:.3f} gpm'.format(dt.datetime.fromtimestamp(t).isoformat(), leakGpm))
+
+if __name__ == '__main__':
+
+    # replay a day's Flo data through the estimator as if it were arriving live
+
+    import ChristieDrModel as cdm
+    import ProcessHydrawiseData as ph
+    import WarmStart as ws
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--date', help = 'date to replay, 20yy-mm-dd (default today)')
+    parser.add_argument('--dataDir', help = 'directory with the Flo and Hydrawise data', default = '/home/tsa/Dropbox/WaterUsageData')
+    parser.add_argument('--warmStart', help = 'warm-start cache to take the toffsets from')
+    parser.add_argument('--threshold', help = 'leak alert threshold, gal/min (default 0.1)', type=float, default=0.1)
+    parser.add_argument('--clear', help = 'leak level that re-arms the alert, gal/min (default 0.8 of the threshold)', type=float)
+    parser.add_argument('--edgeMargin', help = 'sec around each run window not counted as idle (default 300)', type=float, default=300.0)
+    parser.add_argument('--alpha', help = 'weight of each idle interval in the leak average (default 0.05)', type=float, default=0.05)
+    parser.add_argument('--batch', help = 'readings per batch (default 1)', type=int, default=1)
+    parser.add_argument('--archive', help = 'Flo archive to read the day from (see FloArchive.py)')
+    parser.add_argument('--oldSched', help = 'use the old rear schedule', action='store_true')
+    args = parser.parse_args()
+
+    testDateString = args.date if args.date else dt.date.today().isoformat()
+    testDate = dt.datetime.strptime(testDateString, '%Y-%m-%d')
+
+    RearSched, ConstLeakSched = cdm.buildSchedules(testDate, args.oldSched)
+    hydraDatafile, floDataFile = cdm.inputFiles(args.dataDir, testDateString)
+    HydraSched = ph.loadHydraData(hydraDatafile, 1, checkDate=testDate)
+    model, activeFlowLabels = cdm.buildModel(HydraSched, RearSched, ConstLeakSched)
+
+    toffsets = np.zeros(model.nsched)
+    if args.warmStart and os.path.exists(args.warmStart):
+        labels = ws.paramLabels(model)
+        values = ws.warmStartCache(args.warmStart).lookup(testDateString, labels)
+        for (i, j) in enumerate(model.toffsetIndex()):
+            if values[j] is not None:
+                toffsets[i] = values[j]
+
+    estimator = streamingEstimator(model, toffsets, leakThreshold=args.threshold, alpha=args.alpha, onAlert=printAlert,
+                                    leakClear=args.clear, edgeMargin=args.edgeMargin)
+
+    measFlows = cdm.loadFlo(floDataFile, testDateString, args.archive)
+    for start in range(0, len(measFlows), args.batch):
+        estimator.addBatch(measFlows[start:start+args.batch])
+
+    for (label, flow) in estimator.flowData():
+        print(label, flow)
+    if estimator.leakRate is not None:
+        print('idle leak average', 60.0*estimator.leakRate)
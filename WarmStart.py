@@ -0,0 +1,69 @@
+"""
+Warm-start cache: each day's median solution, keyed by schedule id and zone label, kept in a json file
+so that later fits can start from the most recent solution instead of a random guess
+"""
+import json
+import os
+import numpy as np
+
+# parameter labels matching model.sliceList: '<schedule id>:<zone name without spaces>', and
+# '<schedule id>:toffset' for the last element of each block
+
+def paramLabels(flowModel):
+    labels = []
+    for sched in flowModel.schedList:
+        for name in sched.zoneNames:
+            labels.append('{}:{}'.format(sched.id, name.translate({ord(' '):None})))
+        labels.append('{}:toffset'.format(sched.id))
+    return labels
+
+class warmStartCache:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.solutions = {}  # date string -> {label: value}, flows in gal/sec, toffsets in sec
+        if os.path.exists(fileName):
+            with open(fileName) as f:
+                self.solutions = json.load(f)
+
+    def store(self, dateString, labels, flows):
+        # labels from paramLabels(), flows in the same order
+        self.solutions[dateString] = dict(zip(labels, [float(x) for x in flows]))
+
+    def save(self):
+        tmpName = self.fileName + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump(self.solutions, f, indent=1, sort_keys=True)
+        os.replace(tmpName, self.fileName)
+
+    def lookup(self, dateString, labels):
+        # most recent value for each label from a date before dateString, None where there's no history
+        values = [None]*len(labels)
+        for d in sorted(self.solutions, reverse=True):
+            if d >= dateString:
+                continue
+            for (i, label) in enumerate(labels):
+                if values[i] is None and label in self.solutions[d]:
+                    values[i] = self.solutions[d][label]
+            if all(v is not None for v in values):
+                break
+        return values
+
+    def guesses(self, flowModel, dateString, nTrials, rng, flowScatter=0.1, toffsetScatter=30.0):
+        # (nTrials, nParams) initial guesses.  Trial 0 is the previous solution itself; the others
+        # scatter the flows by flowScatter (fractional) and the toffsets by toffsetScatter (sec).
+        # Parameters with no history get the usual random guess
+        values = self.lookup(dateString, paramLabels(flowModel))
+        nParams = flowModel.nFlows + flowModel.nsched
+        guesses = 0.1 + 5.0*rng.random((nTrials, nParams))
+        isToffset = np.zeros(nParams, dtype=bool)
+        isToffset[flowModel.toffsetIndex()] = True
+        for (j, value) in enumerate(values):
+            if value is None:
+                continue
+            if isToffset[j]:
+                col = value + toffsetScatter*rng.standard_normal(nTrials)
+            else:
+                col = value*(1.0 + flowScatter*rng.standard_normal(nTrials))
+            col[0] = value
+            guesses[:, j] = np.clip(col, flowModel.lowerBounds[j], flowModel.upperBounds[j])
+        return guesses
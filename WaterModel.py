@@ -2,8 +2,10 @@ import numpy as np
 from numpy.random import ranf
 import datetime
 from scipy.optimize import least_squares as lsq
-import matplotlib.pyplot as plt
-from matplotlib.font_manager import FontProperties
+from scipy.optimize import lsq_linear, minimize_scalar, OptimizeResult
+from scipy.sparse import lil_matrix, coo_matrix
+
+# matplotlib is imported by printResult only when plotting, so the solver imports without it
 
 # square wave function
 
@@ -23,54 +25,150 @@ def sIntegral(ta, tb, t1, t2):
     tHi = min(t2, tb)
     return tHi - tLow
 
+# vectorized sIntegral: overlap of every interval [ta[i], tb[i]] with every window [t1[j], t2[j]]
+
+def overlapMatrix(ta, tb, t1, t2):
+    tLow = np.maximum(ta[:, np.newaxis], t1[np.newaxis, :])
+    tHi = np.minimum(tb[:, np.newaxis], t2[np.newaxis, :])
+    return np.maximum(tHi - tLow, 0.0)
 
-# schedule for a controller
-# limited at present by assumption a given zone has a single run time and duration
+
+# schedule for a controller.  A zone may have any number of runs (e.g. cycle and soak, or several
+# starts a day); after finalize() the runs are kept as arrays sorted by start time: times holds
+# each run's (start, end) and runZone its zone, so the runs active in a time range are found by
+# bisection
 
 class schedule:
     def __init__(self, controllerId):
         self.id = controllerId
         self.nzones = 0
         self.toffset = 0  # added to schedule times to agree with timestamp() times
-        self.zoneList = []
+        self.zoneNames = []
+        self.zoneIndex = {}
+        self.runList = []
 
     def addZone(self, t, duration, name):
-        self.zoneList.append((t, duration, name))
-        self.nzones += 1
+        # a run of zone name starting at datetime t, duration in minutes.  Runs with the name of
+        # an existing zone add to its windows rather than making a new zone
+        if name not in self.zoneIndex:
+            self.zoneIndex[name] = self.nzones
+            self.zoneNames.append(name)
+            self.nzones += 1
+        self.runList.append((t.timestamp(), duration*60.0, self.zoneIndex[name]))
 
     def setToffset(self, t):
         self.toffset = t
 
     def finalize(self, dump=False):
-        self.times = np.zeros((self.nzones, 2))
-        for (i,zone) in enumerate(self.zoneList):
-            if dump:
-                print(zone)
-            self.times[i, 0] = zone[0].timestamp()
-            self.times[i, 1] = self.times[i, 0] + zone[1]*60.0  # zone[1] is in minutes
+        runs = sorted(self.runList)
+        if dump:
+            for (start, duration, z) in runs:
+                print(datetime.datetime.fromtimestamp(start), duration/60.0, self.zoneNames[z])
+        self.nruns = len(runs)
+        self.times = np.zeros((self.nruns, 2))
+        self.runZone = np.zeros(self.nruns, dtype=int)
+        for (i, (start, duration, z)) in enumerate(runs):
+            self.times[i, 0] = start
+            self.times[i, 1] = start + duration
+            self.runZone[i] = z
+        self.maxDuration = np.amax(self.times[:, 1] - self.times[:, 0]) if self.nruns > 0 else 0.0
+        # (runs, zones) matrix summing each run's column into its zone's
+        self.runMatrix = np.zeros((self.nruns, self.nzones))
+        self.runMatrix[np.arange(self.nruns), self.runZone] = 1.0
+
+    def zoneRuns(self, z):
+        # (start datetime, duration in minutes) of each run of zone z
+        runs = np.nonzero(self.runZone == z)[0]
+        return [(datetime.datetime.fromtimestamp(self.times[i, 0]), float(self.times[i, 1] - self.times[i, 0])/60.0) for i in runs]
+
+    def activeRuns(self, ta, tb):
+        # indices of the runs whose window, shifted by the toffset, meets [ta, tb]: every such run
+        # starts between ta - maxDuration and tb
+        lo = np.searchsorted(self.times[:, 0], ta - self.toffset - self.maxDuration, side='left')
+        hi = np.searchsorted(self.times[:, 0], tb - self.toffset, side='right')
+        runs = np.arange(lo, hi)
+        return runs[self.times[runs, 1] + self.toffset >= ta]
 
     def flow(self, zoneFlows, t):
         assert(len(zoneFlows)==self.nzones)
-        totFlow = 0.
-        for i in range(self.nzones):
-            totFlow += zoneFlows[i] * s(t, self.times[i, 0] + self.toffset, self.times[i, 1] + self.toffset)
-
-        return totFlow
+        runs = self.activeRuns(t, t)
+        return float(np.sum(np.asarray(zoneFlows)[self.runZone[runs]]))
 
     def flowIntegral(self, zoneFlows, ta, tb):
         assert(len(zoneFlows)==self.nzones)
-        flowIntegral = 0.
-        for i in range(self.nzones):
-            flowIntegral += zoneFlows[i] * sIntegral(ta, tb, self.times[i, 0] + self.toffset, self.times[i, 1] + self.toffset)
+        runs = self.activeRuns(ta, tb)
+        overlaps = np.minimum(tb, self.times[runs, 1] + self.toffset) - np.maximum(ta, self.times[runs, 0] + self.toffset)
+        return float(np.dot(overlaps, np.asarray(zoneFlows)[self.runZone[runs]]))
 
-        return flowIntegral
+    def windows(self, toffsets=None):
+        # run start and end times, shifted by the current toffset, or by each of an array
+        # of toffsets giving one row of windows per toffset
+        if toffsets is None:
+            return self.times[:, 0] + self.toffset, self.times[:, 1] + self.toffset
+        toffsets = np.asarray(toffsets)[:, np.newaxis]
+        return self.times[:, 0] + toffsets, self.times[:, 1] + toffsets
 
-    def schedFlow(self, zoneFlows, tArray):
-        schedFlow = np.zeros_like(tArray)
-        for i in range(len(tArray)):
-            schedFlow[i] = self.flow(zoneFlows, tArray[i])
+    def overlaps(self, tArray):
+        # overlap (sec) of each sample interval [tArray[i], tArray[i+1]] with each zone's windows.
+        # The last sample has no following interval, so its row is left at zero
+        t1, t2 = self.windows()
+        overlaps = np.zeros((len(tArray), self.nzones))
+        overlaps[:-1, :] = np.dot(overlapMatrix(tArray[:-1], tArray[1:], t1, t2), self.runMatrix)
+        return overlaps
 
-        return schedFlow
+    def integrals(self, zoneFlows, tArray):
+        # vectorized flowIntegral over all the sample intervals of tArray, touching only the
+        # samples each run overlaps
+        assert(len(zoneFlows)==self.nzones)
+        rows, zones, overlaps, slopes = self.overlapEntries(tArray)
+        return np.bincount(rows, weights=overlaps*np.asarray(zoneFlows)[zones], minlength=len(tArray))
+
+    def overlapSlopes(self, tArray):
+        # derivative of overlaps() with respect to toffset: +1 where a window end falls
+        # inside a sample interval, -1 where a window start does, 0 elsewhere
+        t1, t2 = self.windows()
+        ta = tArray[:-1, np.newaxis]
+        tb = tArray[1:, np.newaxis]
+        t1 = t1[np.newaxis, :]
+        t2 = t2[np.newaxis, :]
+        slopes = np.zeros((len(tArray), self.nzones))
+        inside = np.minimum(tb, t2) - np.maximum(ta, t1) > 0
+        slopes[:-1, :] = np.dot(np.where(inside, (t2 < tb).astype(float) - (t1 > ta), 0.0), self.runMatrix)
+        return slopes
+
+    def overlapEntries(self, tArray, toffsets=None):
+        # the nonzero entries of overlaps() and overlapSlopes(), one per run and sample interval,
+        # found by bisecting the sorted sample times: (rows, zones, overlaps, slopes).  Two runs
+        # of a zone in one interval give two entries.  With an array of toffsets the entries for
+        # all of them are found together, and (trials, rows, zones, overlaps, slopes) is returned,
+        # trials being the index into toffsets of each entry
+        t1, t2 = self.windows(toffsets)
+        t1 = t1.ravel()
+        t2 = t2.ravel()
+        iLo = np.searchsorted(tArray[1:], t1, side='right')
+        iHi = np.maximum(np.searchsorted(tArray[:-1], t2, side='left'), iLo)
+        counts = iHi - iLo
+        runs = np.repeat(np.arange(len(t1)), counts)  # index into the (trial, run) windows
+        rows = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts) + iLo[runs]
+        ta = tArray[rows]
+        tb = tArray[rows + 1]
+        overlaps = np.minimum(tb, t2[runs]) - np.maximum(ta, t1[runs])
+        slopes = (t2[runs] < tb).astype(float) - (t1[runs] > ta)
+        zones = self.runZone[runs % max(self.nruns, 1)]
+        if toffsets is None:
+            return rows, zones, overlaps, slopes
+        return runs // max(self.nruns, 1), rows, zones, overlaps, slopes
+
+    def schedFlow(self, zoneFlows, tArray):
+        # flow at each of the sorted times tArray: each run adds its zone's flow to the times
+        # inside its window
+        assert(len(zoneFlows)==self.nzones)
+        t1, t2 = self.windows()
+        runFlows = np.asarray(zoneFlows, dtype=float)[self.runZone]
+        steps = np.zeros(len(tArray) + 1)
+        np.add.at(steps, np.searchsorted(tArray, t1, side='left'), runFlows)
+        np.add.at(steps, np.searchsorted(tArray, t2, side='right'), -runFlows)
+        return np.cumsum(steps)[:-1]
         
 
 """
@@ -85,6 +183,7 @@ class model:
         self.nsched = 0
         self.nFlows = 0
         self.indxStart = 0
+        self.nCalls = 0  # optFunc evaluations, for solver statistics
         # array of slices to partition the flows argument by schedule? Use np.s_[i:j]
 
     def addSched(self, sched):
@@ -105,43 +204,405 @@ class model:
         self.indxStart += sched.nzones + 1
         self.nsched += 1
         self.nFlows += sched.nzones
-    
+
+    def predict(self, flows, flowTimes):
+        # model gallons in each sample interval; sets the toffset of each schedule from flows
+        flowPredict = np.zeros_like(flowTimes)
+        for (i, sched) in enumerate(self.schedList):
+            parameterBlock = flows[self.sliceList[i]]
+            zoneFlows = parameterBlock[0:sched.nzones]
+            tOffset = parameterBlock[-1]
+            sched.setToffset(tOffset)
+            flowPredict += sched.integrals(zoneFlows, flowTimes)
+
+        return flowPredict
+
+    def batchPredict(self, flowsArr, flowTimes):
+        # predict() for each row of a (nTrials, nParams) array, all the rows together from the
+        # overlap entries at their toffsets; leaves the schedules' toffsets alone
+        nTrials = flowsArr.shape[0]
+        nSamples = len(flowTimes)
+        flowPredict = np.zeros(nTrials*nSamples)
+        for (i, sched) in enumerate(self.schedList):
+            parameterBlock = flowsArr[:, self.sliceList[i]]
+            trials, rows, zones, overlaps, slopes = sched.overlapEntries(flowTimes, parameterBlock[:, -1])
+            flowPredict += np.bincount(trials*nSamples + rows, weights=overlaps*parameterBlock[trials, zones],
+                                       minlength=nTrials*nSamples)
+
+        return flowPredict.reshape(nTrials, nSamples)
+
+    def toffsetIndex(self):
+        # position of each schedule's toffset in the flows argument
+        return np.array([sl.stop - 1 for sl in self.sliceList], dtype=int)
+
+    def flowIndex(self):
+        # positions of the zone flows in the flows argument, in schedule order
+        return np.setdiff1d(np.arange(self.nFlows + self.nsched), self.toffsetIndex())
+
+    def design(self, toffsets, flowTimes):
+        # for fixed toffsets predict() is design(...) dotted with the zone flows
+        cols = []
+        for (i, sched) in enumerate(self.schedList):
+            sched.setToffset(toffsets[i])
+            cols.append(sched.overlaps(flowTimes))
+
+        return np.hstack(cols)
+
+    def jacobian(self, flows, flowTimes):
+        # derivative of predict() with respect to flows.  Linear in the zone flows; the
+        # toffset column is the zone flows at the window edges
+        jac = np.zeros((len(flowTimes), len(flows)))
+        for (i, sched) in enumerate(self.schedList):
+            parameterBlock = flows[self.sliceList[i]]
+            zoneFlows = parameterBlock[0:sched.nzones]
+            sched.setToffset(parameterBlock[-1])
+            j = self.sliceList[i].start
+            jac[:, j:j+sched.nzones] = sched.overlaps(flowTimes)
+            jac[:, j+sched.nzones] = np.dot(sched.overlapSlopes(flowTimes), zoneFlows)
+
+        return jac
+
+    def sparseJacobian(self, flows, flowTimes):
+        # jacobian() as a scipy.sparse matrix, built without the dense (samples, parameters) array
+        rows = []
+        cols = []
+        vals = []
+        for (i, sched) in enumerate(self.schedList):
+            parameterBlock = flows[self.sliceList[i]]
+            sched.setToffset(parameterBlock[-1])
+            r, z, overlaps, slopes = sched.overlapEntries(flowTimes)
+            j = self.sliceList[i].start
+            edges = slopes != 0
+            rows += [r, r[edges]]
+            cols += [j + z, np.repeat(j + sched.nzones, np.count_nonzero(edges))]
+            vals += [overlaps, slopes[edges]*parameterBlock[z[edges]]]
+
+        # entries with the same row and column (toffset) are summed
+        return coo_matrix((np.hstack(vals), (np.hstack(rows), np.hstack(cols))),
+                          shape=(len(flowTimes), self.nFlows + self.nsched)).tocsr()
+
+    def batchNormalEquations(self, flowsArr, flowTimes, weights, resids):
+        # J'WJ and J'Wr for each row of a (nTrials, nParams) array, J being the jacobian there and
+        # W the diagonal of that row of weights.  The trials' sparse jacobians (as sparseJacobian)
+        # are the diagonal blocks of one matrix, so all the products are done at once and the work
+        # is in proportion to the samples the windows touch.  Leaves the schedules' toffsets alone
+        nTrials, nParams = flowsArr.shape
+        nSamples = len(flowTimes)
+        rows = []
+        cols = []
+        vals = []
+        for (i, sched) in enumerate(self.schedList):
+            parameterBlock = flowsArr[:, self.sliceList[i]]
+            trials, r, z, overlaps, slopes = sched.overlapEntries(flowTimes, parameterBlock[:, -1])
+            j = self.sliceList[i].start
+            edges = slopes != 0
+            rows += [trials*nSamples + r, trials[edges]*nSamples + r[edges]]
+            cols += [trials*nParams + j + z, trials[edges]*nParams + j + sched.nzones]
+            vals += [overlaps, slopes[edges]*parameterBlock[trials[edges], z[edges]]]
+
+        jac = coo_matrix((np.hstack(vals), (np.hstack(rows), np.hstack(cols))),
+                         shape=(nTrials*nSamples, nTrials*nParams)).tocsr()
+        jtw = jac.T.multiply(np.ravel(weights)).tocsr()
+        normal = (jtw @ jac).tocoo()
+        JtWJ = np.zeros((nTrials, nParams, nParams))
+        JtWJ[normal.row // nParams, normal.row % nParams, normal.col % nParams] = normal.data
+        return JtWJ, (jtw @ np.ravel(resids)).reshape(nTrials, nParams)
+
+    def jacSparsity(self, flowTimes):
+        # which samples each parameter can touch anywhere inside the toffset bounds
+        ta = flowTimes[:-1]
+        tb = flowTimes[1:]
+        sparsity = lil_matrix((len(flowTimes), self.nFlows + self.nsched), dtype=int)
+        for (i, sched) in enumerate(self.schedList):
+            j = self.sliceList[i].start
+            k = j + sched.nzones  # toffset column
+            lo = self.lowerBounds[k]
+            hi = self.upperBounds[k]
+            for r in range(sched.nruns):
+                t1 = sched.times[r, 0]
+                t2 = sched.times[r, 1]
+                rows = np.nonzero((tb >= t1 + lo) & (ta <= t2 + hi))[0]
+                sparsity[rows, j+sched.runZone[r]] = 1
+                edges = ((tb >= t1 + lo) & (ta <= t1 + hi)) | ((tb >= t2 + lo) & (ta <= t2 + hi))
+                sparsity[np.nonzero(edges)[0], k] = 1
+
+        return sparsity.tocsr()
+
 def optFunc(flows, *args): # take out of class, give it a model as one of *args
     # flows arg needs to include timeoffset for each sched
     flowMeas = args[0] # array of [time, gallons in time interval]
     flowTimes = flowMeas[:,0]  # sec past the Epoch
     flowIntegrals = flowMeas[:,1]  # gallons
     flowModel = args[1]
+    flowModel.nCalls += 1
 
-    flowPredict = np.zeros_like(flowIntegrals)
-    for (i, sched) in enumerate(flowModel.schedList):
-        parameterBlock = flows[flowModel.sliceList[i]]
-        zoneFlows = parameterBlock[0:sched.nzones]
-        tOffset = parameterBlock[-1]
-        sched.setToffset(tOffset)
-        for i in range(len(flowTimes)-1):
-            flowPredict[i] += sched.flowIntegral(zoneFlows, flowTimes[i], flowTimes[i+1])
+    flowPredict = flowModel.predict(flows, flowTimes)
             
     return flowIntegrals - flowPredict
 
+def optJac(flows, *args):
+    # analytic Jacobian of optFunc, same arguments
+    flowMeas = args[0]
+    flowModel = args[1]
+    return -flowModel.jacobian(flows, flowMeas[:,0])
+
+def optSparseJac(flows, *args):
+    # optJac as a scipy.sparse matrix
+    flowMeas = args[0]
+    flowModel = args[1]
+    return -flowModel.sparseJacobian(flows, flowMeas[:,0])
+
+def timeOfDay(tArray):
+    # local hour + minute/60 for each time, as from datetime.fromtimestamp(t).  The UTC offset
+    # is looked up once per quarter hour (DST changes fall on those boundaries) not once per time
+    tArray = np.asarray(tArray, dtype=float)
+    quarters, inverse = np.unique(np.floor(tArray/900.0)*900.0, return_inverse=True)
+    epoch = datetime.datetime(1970, 1, 1)
+    offsets = np.array([(datetime.datetime.fromtimestamp(q) - epoch).total_seconds() - q for q in quarters])
+    minutes = np.floor(np.mod(tArray + offsets[inverse], 86400.0)/60.0)
+    return minutes//60 + np.mod(minutes, 60)/60.0
+
 def formatResids(flowMeasurements, resids):
     fResids = np.zeros_like(flowMeasurements)
-    for i in range(len(resids)):
-        dt = datetime.datetime.fromtimestamp(flowMeasurements[i,0])
-        fResids[i, 0] = dt.time().hour + dt.time().minute/60.0
-        fResids[i, 1] = resids[i]
+    fResids[:len(resids), 0] = timeOfDay(flowMeasurements[:len(resids), 0])
+    fResids[:len(resids), 1] = resids
 
     return fResids
 
-def findFlows(flowModel, flowMeasurements):
-    flowGuess = 0.1 + 5.0*ranf(flowModel.nFlows + flowModel.nsched) # includes timeoffsets
-    result = lsq(optFunc, flowGuess, bounds=(flowModel.lowerBounds, flowModel.upperBounds), loss='huber',args=(flowMeasurements, flowModel))
+def solveZoneFlows(flowModel, flowMeasurements, toffsets):
+    # with the toffsets fixed the residual is linear in the zone flows, which are bounded below by 0
+    A = flowModel.design(toffsets, flowMeasurements[:,0])
+    sol = lsq_linear(A, flowMeasurements[:,1], bounds=(0, np.inf))
+    return sol.x, sol.cost
+
+def searchToffsets(flowModel, flowMeasurements, gridStep=60.0, nSweeps=2):
+    # variable projection: coordinate search over each schedule's toffset on a coarse grid,
+    # refined by a bounded golden-section/Brent search, with the zone flows solved at each point
+    toffsets = np.zeros(flowModel.nsched)
+    iOff = flowModel.toffsetIndex()
+    lo = flowModel.lowerBounds[iOff]
+    hi = flowModel.upperBounds[iOff]
+
+    def cost(t, i):
+        trial = toffsets.copy()
+        trial[i] = t
+        return solveZoneFlows(flowModel, flowMeasurements, trial)[1]
+
+    for sweep in range(nSweeps):
+        for (i, sched) in enumerate(flowModel.schedList):
+            if sched.nzones == 0:
+                continue
+            grid = np.arange(lo[i], hi[i] + 0.5*gridStep, gridStep)
+            costs = np.array([cost(t, i) for t in grid])
+            best = grid[np.argmin(costs)]
+            refined = minimize_scalar(cost, bounds=(max(lo[i], best-gridStep), min(hi[i], best+gridStep)),
+                                      args=(i,), method='bounded', options={'xatol': 0.5})
+            if refined.fun < np.amin(costs):
+                toffsets[i] = refined.x
+            else:
+                toffsets[i] = best
+
+    return toffsets
+
+def varproGuess(flowModel, flowMeasurements):
+    # deterministic starting point: searched toffsets and their closed-form zone flows
+    toffsets = searchToffsets(flowModel, flowMeasurements)
+    zoneFlows, cost = solveZoneFlows(flowModel, flowMeasurements, toffsets)
+    flowGuess = np.zeros(flowModel.nFlows + flowModel.nsched)
+    flowGuess[flowModel.toffsetIndex()] = toffsets
+    flowGuess[flowModel.flowIndex()] = zoneFlows
+    return flowGuess
+
+# method='lsq' starts least_squares from a random guess, drawn from rng (a numpy Generator)
+# if given, otherwise from the global numpy random state, or from x0 (e.g. a warm start) if
+# given; method='varpro' starts it from varproGuess, so it only has to do the final Huber refinement.
+# jac='analytic' uses optJac, or with sparse=True optSparseJac and the lsmr trust-region solver,
+# which never forms the dense jacobian; it pays off at fine sampling (about 3x faster at 1 s steps)
+# but takes many more evaluations at 60 s steps.  '2-point' or '3-point' fall back to finite differences,
+# which only evaluate the samples each parameter can touch when sparse=True (least_squares then
+# also uses lsmr, and takes many more evaluations than the dense differences)
+
+def findFlows(flowModel, flowMeasurements, jac='analytic', sparse=False, method='lsq', rng=None, x0=None):
+    nParams = flowModel.nFlows + flowModel.nsched # includes timeoffsets
+    if method == 'varpro':
+        flowGuess = varproGuess(flowModel, flowMeasurements)
+    elif x0 is not None:
+        flowGuess = x0
+    elif rng is not None:
+        flowGuess = 0.1 + 5.0*rng.random(nParams)
+    else:
+        flowGuess = 0.1 + 5.0*ranf(nParams)
+    lsqArgs = {}
+    if jac == 'analytic':
+        if sparse:
+            lsqArgs['jac'] = optSparseJac
+            lsqArgs['tr_solver'] = 'lsmr'
+        else:
+            lsqArgs['jac'] = optJac
+    else:
+        lsqArgs['jac'] = jac
+        if sparse:
+            lsqArgs['jac_sparsity'] = flowModel.jacSparsity(flowMeasurements[:,0])
+    nCalls = flowModel.nCalls
+    result = lsq(optFunc, flowGuess, bounds=(flowModel.lowerBounds, flowModel.upperBounds), loss='huber',args=(flowMeasurements, flowModel), **lsqArgs)
+    result.nOptFunc = flowModel.nCalls - nCalls
     plotResids = formatResids(flowMeasurements, result.fun)
     return result
 
+def huberCost(resids, fScale=1.0):
+    # least_squares' loss='huber' cost, summed over the last axis
+    z = (resids/fScale)**2
+    rho = np.where(z <= 1, z, 2*np.sqrt(z) - 1)
+    return 0.5 * fScale**2 * np.sum(rho, axis=-1)
+
+def batchChunks(nTrials, nSamples, maxRows=2**17):
+    # slices of the trials with at most maxRows samples among them (at least one trial each),
+    # bounding the memory of the batch calls at fine sampling
+    size = max(1, maxRows // max(nSamples, 1))
+    return [np.s_[k:k+size] for k in range(0, nTrials, size)]
+
+def trustRegionSteps(H, g, radius):
+    # minimizers of -g.s + s.H.s/2 subject to |s| <= radius, one per row of the batch: eigenvectors
+    # of each H, then Newton iterations on the secular equation 1/|s(mu)| = 1/radius for the
+    # Levenberg-Marquardt parameter mu of the steps that would leave the region
+    lam, Q = np.linalg.eigh(H)
+    gq = np.einsum('tji,tj->ti', Q, g)
+    floor = np.finfo(float).eps**2*np.amax(np.abs(lam), axis=1, keepdims=True) + 1e-300
+    lower = np.maximum(0.0, -lam[:, 0])
+    mu = np.where(lower > 0, lower + floor[:, 0], 0.0)
+    for i in range(30):
+        denom = np.maximum(lam + mu[:, np.newaxis], floor)
+        steps = gq/denom
+        norm = np.linalg.norm(steps, axis=1)
+        outside = norm > radius*(1 + 1e-6)
+        if not outside.any():
+            break
+        dNorm = np.sum(steps**2/denom, axis=1)
+        update = norm**2*(norm/radius - 1)/np.where(dNorm > 0, dNorm, 1.0)
+        mu = np.where(outside, np.maximum(mu + update, lower), mu)
+    return np.einsum('tij,tj->ti', Q, gq/np.maximum(lam + mu[:, np.newaxis], floor))
+
+def findFlowsBatch(flowModel, flowMeasurements, nTrials, rng=None, fScale=1.0, maxIter=200, ftol=1e-8, xtol=1e-8, gtol=1e-8, x0=None):
+    # All nTrials random starts (or the rows of x0) stepped together by least_squares' trust-region
+    # iteration (method='trf') on the Huber loss.  As there, samples past fScale pull on the gradient
+    # but add no curvature, each trial has its own radius, which grows or shrinks with the ratio of
+    # the actual to the predicted reduction of its cost, only the steps that reduce the cost are taken,
+    # and variables are scaled by their distance to the bound the gradient points at (Coleman-Li).
+    # Steps that would cross a bound stop just short of it rather than reflecting off it.  The normal
+    # equations of all the trials come from their sparse jacobians in one call.  Trials drop out of
+    # the batch as they converge.  Returns a list of OptimizeResult like findFlows, in trial order
+    nParams = flowModel.nFlows + flowModel.nsched
+    if x0 is not None:
+        flowsArr = np.array(x0, dtype=float)
+    elif rng is not None:
+        flowsArr = 0.1 + 5.0*rng.random((nTrials, nParams))
+    else:
+        flowsArr = 0.1 + 5.0*ranf((nTrials, nParams))
+    flowTimes = flowMeasurements[:,0]
+    flowIntegrals = flowMeasurements[:,1]
+    lb = flowModel.lowerBounds
+    ub = flowModel.upperBounds
+
+    def batchPredict(P):
+        return np.vstack([flowModel.batchPredict(P[chunk], flowTimes) for chunk in batchChunks(len(P), len(flowTimes))])
+
+    def batchNormalEquations(P, w, r):
+        chunks = batchChunks(len(P), len(flowTimes))
+        normals = [flowModel.batchNormalEquations(P[chunk], flowTimes, w[chunk], r[chunk]) for chunk in chunks]
+        return np.concatenate([n[0] for n in normals]), np.concatenate([n[1] for n in normals])
+
+    def scaling(P, g):
+        # Coleman-Li scaling vector v and its derivative dv, for the descent directions g
+        up = (g > 0) & np.isfinite(ub)
+        down = (g < 0) & np.isfinite(lb)
+        v = np.where(up, ub - P, np.where(down, P - lb, 1.0))
+        dv = np.where(up, -1.0, np.where(down, 1.0, 0.0))
+        return v, dv
+
+    resids = flowIntegrals - batchPredict(flowsArr)
+    cost = huberCost(resids, fScale)
+    JtWJ = np.zeros((nTrials, nParams, nParams))
+    JtWr = np.zeros((nTrials, nParams))  # descent directions, minus the gradients of the costs
+    radius = np.zeros(nTrials)
+    stale = np.ones(nTrials, dtype=bool)  # moved since their normal equations were formed
+    nfev = np.ones(nTrials, dtype=int)
+    njev = np.zeros(nTrials, dtype=int)
+    status = np.zeros(nTrials, dtype=int)  # 0: max iterations, as in least_squares
+    active = np.ones(nTrials, dtype=bool)
+
+    for iteration in range(maxIter):
+        fresh = np.nonzero(active & stale)[0]
+        if len(fresh):
+            r = resids[fresh]
+            # the Huber weights of the gradient, and of the curvature (eps past fScale, as least_squares)
+            w = np.where(np.abs(r) <= fScale, 1.0, fScale/np.maximum(np.abs(r), 1e-300))
+            hw = np.where(np.abs(r) <= fScale, 1.0, np.finfo(float).eps)
+            JtWJ[fresh], JtWr[fresh] = batchNormalEquations(flowsArr[fresh], hw, r*w/hw)
+            stale[fresh] = False
+            v, dv = scaling(flowsArr[fresh], JtWr[fresh])
+            first = njev[fresh] == 0
+            startRadius = np.linalg.norm(flowsArr[fresh]/np.sqrt(v), axis=1)
+            radius[fresh[first]] = np.where(startRadius > 0, startRadius, 1.0)[first]
+            njev[fresh] += 1
+            gtolDone = np.amax(np.abs(JtWr[fresh]*v), axis=1) < gtol
+            status[fresh[gtolDone]] = 1
+            active[fresh[gtolDone]] = False
+
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+        P = flowsArr[idx]
+        b = JtWr[idx]
+        v, dv = scaling(P, b)
+        d = np.sqrt(v)
+        # the quadratic model in the scaled variables, with Coleman-Li's curvature term on the diagonal
+        Hs = JtWJ[idx]*d[:, :, np.newaxis]*d[:, np.newaxis, :] + (-b*dv)[:, :, np.newaxis]*np.eye(nParams)
+        bs = b*d
+        scaledStep = trustRegionSteps(Hs, bs, radius[idx])
+        step = d*scaledStep
+        # steps that would take a variable across a bound are cut back to just inside it, and
+        # variables already on a bound are kept off the wrong side of it
+        with np.errstate(divide='ignore', invalid='ignore'):
+            toBound = np.where(step > 0, (ub - P)/step, np.where(step < 0, (lb - P)/step, np.inf))
+        toBound[(P <= lb) | (P >= ub)] = np.inf
+        stride = np.minimum(1.0, 0.995*np.amin(toBound, axis=1))
+        Pnew = np.clip(P + step*stride[:, np.newaxis], lb, ub)
+        step = Pnew - P
+        scaledStep = np.where(d > 0, step/np.where(d > 0, d, 1.0), 0.0)
+        predicted = np.einsum('ti,ti->t', bs, scaledStep) - 0.5*np.einsum('ti,tij,tj->t', scaledStep, Hs, scaledStep)
+        rNew = flowIntegrals - batchPredict(Pnew)
+        costNew = huberCost(rNew, fScale)
+        nfev[idx] += 1
+
+        actual = cost[idx] - costNew
+        ratio = np.where(predicted > 0, actual/np.where(predicted > 0, predicted, 1.0), 0.0)
+        stepNorm = np.linalg.norm(scaledStep, axis=1)
+        radius[idx] = np.where(ratio < 0.25, 0.25*stepNorm,
+                               np.where((ratio > 0.75) & (stepNorm > 0.95*radius[idx]), 2.0*radius[idx], radius[idx]))
+
+        fConverged = (actual < ftol*cost[idx]) & (ratio > 0.25)
+        xConverged = np.linalg.norm(step, axis=1) < xtol*(xtol + np.linalg.norm(P, axis=1))
+        better = actual > 0
+        flowsArr[idx[better]] = Pnew[better]
+        resids[idx[better]] = rNew[better]
+        cost[idx[better]] = costNew[better]
+        stale[idx[better]] = True
+        status[idx[fConverged]] = 2
+        status[idx[xConverged]] = 3
+        status[idx[fConverged & xConverged]] = 4
+        active[idx[fConverged | xConverged]] = False
+
+    results = []
+    for n in range(nTrials):
+        results.append(OptimizeResult(x=flowsArr[n], fun=resids[n], cost=float(cost[n]), nfev=int(nfev[n]), njev=int(njev[n]),
+                                      status=int(status[n]), success=bool(status[n] > 0)))
+    return results
+
 def printResult(result, flowModel, plotLegend=False):
     flows = result.x
     if plotLegend:
+        import matplotlib.pyplot as plt
+        from matplotlib.font_manager import FontProperties
         xpos = 0.6
         ypos = 0.85
         font = FontProperties()
@@ -149,7 +610,7 @@ def printResult(result, flowModel, plotLegend=False):
     for (i,sched) in enumerate(flowModel.schedList):
         schedFlows = flows[flowModel.sliceList[i]]
         for j in range(sched.nzones):
-            text = '{} :\t {:.3f} gpm'.format(sched.zoneList[j][2], schedFlows[j]*60)
+            text = '{} :\t {:.3f} gpm'.format(sched.zoneNames[j], schedFlows[j]*60)
             if plotLegend:
                 plt.figtext(xpos, ypos, text, fontproperties=font)
                 ypos -= 0.025
@@ -0,0 +1,38 @@
+import numpy as np
+import AnomalyDetect as ad
+
+def constantHistory(nDays, flow):
+    # a zone whose trials give exactly the same flow every day: MAD and sigma are zero
+    flows = np.full((nDays, 1), flow)
+    sigmas = np.zeros((nDays, 1))
+    return flows, sigmas
+
+def test_zero_spread_ignores_small_deviations():
+    flows, sigmas = constantHistory(40, 5.0)
+    flows[-1, 0] = 5.002
+    median, mad, scores, flagged = ad.detect(flows, sigmas, window=28, k=4.0, minPeriods=7)
+    assert mad[-1, 0] == 0.0
+    assert not flagged.any()
+    assert abs(scores[-1, 0]) < 1.0
+
+def test_zero_spread_still_flags_large_deviations():
+    flows, sigmas = constantHistory(40, 5.0)
+    flows[-1, 0] = 6.0
+    median, mad, scores, flagged = ad.detect(flows, sigmas, window=28, k=4.0, minPeriods=7)
+    assert flagged[-1, 0]
+    assert not flagged[:-1].any()
+    # floored at relFloor*|median| = 0.05 gpm
+    assert np.isclose(scores[-1, 0], 20.0)
+
+def test_floor_applies_at_zero_baseline():
+    flows, sigmas = constantHistory(40, 0.0)
+    flows[-1, 0] = 0.005
+    median, mad, scores, flagged = ad.detect(flows, sigmas, absFloor=0.01, relFloor=0.01)
+    assert np.isfinite(scores[-1, 0])
+    assert not flagged[-1, 0]
+
+def test_no_baseline_before_min_periods():
+    flows, sigmas = constantHistory(10, 5.0)
+    median, mad, scores, flagged = ad.detect(flows, sigmas, window=28, minPeriods=7)
+    assert np.all(np.isnan(median[:7]))
+    assert not flagged.any()
@@ -0,0 +1,64 @@
+import os
+import time
+
+import numpy as np
+import pytest
+import ProcessFloData as pf
+
+CSV = '''"Date","Gallons"
+"07/01/2019 12:00 AM","0.5"
+"07/01/2019 12:01 AM","0.25"
+"07/01/2019 11:59 PM","1.0"
+"Total","1.75"
+"Summary","Gallons"
+'''
+
+@pytest.fixture
+def timeZone(monkeypatch):
+    def setZone(name):
+        monkeypatch.setenv('TZ', name)
+        time.tzset()
+    yield setZone
+    monkeypatch.undo()
+    time.tzset()
+
+def writeCsv(tmp_path):
+    fileName = tmp_path / 'total-consumption-last-day.csv'
+    fileName.write_text(CSV)
+    return str(fileName)
+
+def test_parses_the_day_between_the_markers(tmp_path, timeZone):
+    timeZone('UTC')
+    decoded = pf.loadFloData(writeCsv(tmp_path), useCache=False)
+    assert decoded[:, 0].tolist() == [1561939200.0, 1561939260.0, 1562025540.0]
+    assert decoded[:, 1].tolist() == [0.5, 0.25, 1.0]
+
+def test_sidecar_is_reused_until_the_csv_changes(tmp_path, timeZone):
+    timeZone('UTC')
+    fileName = writeCsv(tmp_path)
+    first = pf.loadFloData(fileName)
+    assert os.path.exists(pf.cacheFileName(fileName))
+    np.save(pf.cacheFileName(fileName), np.vstack((np.load(pf.cacheFileName(fileName))[:2], [[0.0, 9.0]])))
+    assert pf.loadFloData(fileName).tolist() == [[0.0, 9.0]]  # served from the sidecar
+
+    os.utime(fileName, (0, 0))
+    assert np.array_equal(pf.loadFloData(fileName), first)
+
+def test_sidecar_is_reparsed_in_another_time_zone(tmp_path, timeZone):
+    fileName = writeCsv(tmp_path)
+    timeZone('UTC')
+    utc = pf.loadFloData(fileName)
+    timeZone('America/Los_Angeles')
+    local = pf.loadFloData(fileName)
+    assert np.array_equal(local[:, 0] - utc[:, 0], np.repeat(25200.0, 3))
+    assert np.array_equal(local, pf.loadFloData(fileName, useCache=False))
+    timeZone('UTC')
+    assert np.array_equal(pf.loadFloData(fileName), utc)
+
+def test_unreadable_sidecar_is_written_again(tmp_path, timeZone):
+    timeZone('UTC')
+    fileName = writeCsv(tmp_path)
+    with open(pf.cacheFileName(fileName), 'wb') as f:
+        f.write(b'\x93NUMPY')  # cut short
+    decoded = pf.loadFloData(fileName)
+    assert np.array_equal(np.load(pf.cacheFileName(fileName))[2:], decoded)
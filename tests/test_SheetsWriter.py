@@ -0,0 +1,123 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import SheetsWriter as sw
+
+class fakeSheets(HTTPServer):
+    # answers each values.append with the next of statuses (then 200), keeping the bodies
+
+    def __init__(self, statuses):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), fakeHandler)
+        self.statuses = list(statuses)
+        self.requests = []
+
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+class fakeHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.server.requests.append((self.path, body))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        reply = json.dumps({'updates': {'updatedRows': len(body['values'])}} if status == 200 else {'error': status}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server(request):
+    servers = []
+    def start(statuses=()):
+        httpd = fakeSheets(statuses)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return httpd
+    yield start
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+def flush(url, outbox, sleeps):
+    return sw.flushOutbox(sw.restTransport(url, timeout=5), 'sheetId', outbox=str(outbox), sleep=sleeps.append)
+
+ROWS = [[1.0, 2.0, '2026-07-01'], [3.0, 4.0, '2026-07-02']]
+
+def test_sends_pending_rows_in_one_append(server, tmp_path):
+    httpd = server()
+    outbox = tmp_path / 'outbox.jsonl'
+    sw.queueRows(ROWS, str(outbox))
+    sleeps = []
+    assert flush(httpd.url(), outbox, sleeps) == 2
+    assert len(httpd.requests) == 1
+    path, body = httpd.requests[0]
+    assert path.startswith('/v4/spreadsheets/sheetId/values/Model%20Fit:append')
+    assert body == {'values': ROWS}
+    assert sw.pendingRows(str(outbox)) == []
+    assert sleeps == []
+
+def test_retries_transient_errors(server, tmp_path):
+    httpd = server([503, 429])
+    outbox = tmp_path / 'outbox.jsonl'
+    sw.queueRows(ROWS, str(outbox))
+    sleeps = []
+    assert flush(httpd.url(), outbox, sleeps) == 2
+    assert len(httpd.requests) == 3
+    assert sleeps == [2.0, 4.0]
+    assert sw.pendingRows(str(outbox)) == []
+
+def test_rejected_rows_move_out_of_the_outbox(server, tmp_path):
+    httpd = server([400])
+    outbox = tmp_path / 'outbox.jsonl'
+    sw.queueRows(ROWS, str(outbox))
+    sleeps = []
+    assert flush(httpd.url(), outbox, sleeps) == 0
+    assert len(httpd.requests) == 1
+    assert sleeps == []
+    assert sw.pendingRows(str(outbox)) == []
+    assert sw.pendingRows(sw.rejectedFile(str(outbox))) == ROWS
+
+    # the next row isn't blocked by the rejected ones
+    sw.queueRows(ROWS[:1], str(outbox))
+    assert flush(httpd.url(), outbox, sleeps) == 1
+    assert httpd.requests[-1][1] == {'values': ROWS[:1]}
+
+def test_authentication_errors_are_not_retried(server, tmp_path):
+    httpd = server([401])
+    outbox = tmp_path / 'outbox.jsonl'
+    sw.queueRows(ROWS, str(outbox))
+    sleeps = []
+    assert flush(httpd.url(), outbox, sleeps) == 0
+    assert len(httpd.requests) == 1
+    assert sleeps == []
+    assert sw.pendingRows(str(outbox)) == ROWS
+
+def test_refused_connection_keeps_rows_pending(tmp_path):
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()  # nothing listens there now
+    outbox = tmp_path / 'outbox.jsonl'
+    sw.queueRows(ROWS, str(outbox))
+    sleeps = []
+    assert flush('http://127.0.0.1:{}'.format(port), outbox, sleeps) == 0
+    assert sleeps == [2.0, 4.0, 8.0, 16.0]
+    assert sw.pendingRows(str(outbox)) == ROWS
+
+def test_failure_kinds():
+    class googleError(Exception):
+        def __init__(self, status):
+            self.resp = type('resp', (), {'status': str(status)})()
+    assert sw.failureKind(googleError(500)) == 'transient'
+    assert sw.failureKind(googleError(403)) == 'fatal'
+    assert sw.failureKind(googleError(404)) == 'rejected'
+    assert sw.failureKind(ConnectionResetError()) == 'transient'
+    assert sw.failureKind(socket.timeout()) == 'transient'
+    assert sw.failureKind(ValueError('bad credentials')) == 'fatal'
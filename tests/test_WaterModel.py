@@ -0,0 +1,98 @@
+import datetime
+
+import numpy as np
+import WaterModel as wm
+
+START = datetime.datetime(2019, 8, 1, 4, 0)
+
+def makeSchedule(controllerId, runs):
+    # runs of (minutes after START, duration in minutes, zone name)
+    sched = wm.schedule(controllerId)
+    for (minutes, duration, name) in runs:
+        sched.addZone(START + datetime.timedelta(minutes=minutes), duration, name)
+    sched.finalize()
+    return sched
+
+# zone A runs three times, and two of its runs overlap each other; B overlaps A's second run;
+# C runs inside a single sample interval
+FRONT = [(0, 10, 'A'), (5, 10, 'A'), (12, 6, 'B'), (30, 0.5, 'C'), (50, 20, 'A')]
+# a second controller running alongside the first
+BACK = [(3, 4, 'D'), (8, 30, 'E')]
+
+def sampleTimes():
+    # irregular intervals, some much shorter than a minute, running past the last window
+    steps = np.tile([60.0, 30.0, 1.0, 89.0, 120.0], 16)
+    return START.timestamp() - 120.0 + np.concatenate(([0.0], np.cumsum(steps)))
+
+def expectedIntegrals(sched, zoneFlows, toffset, flowTimes):
+    # gallons in each sample interval, run by run with sIntegral
+    expected = np.zeros(len(flowTimes))
+    for i in range(len(flowTimes) - 1):
+        for (t1, t2), z in zip(sched.times, sched.runZone):
+            expected[i] += zoneFlows[z]*wm.sIntegral(flowTimes[i], flowTimes[i+1], t1 + toffset, t2 + toffset)
+    return expected
+
+def twoScheduleModel():
+    model = wm.model()
+    model.addSched(makeSchedule(1, FRONT))
+    model.addSched(makeSchedule(2, BACK))
+    return model
+
+# zone flows of FRONT, its toffset, zone flows of BACK, its toffset
+FLOWS = np.array([0.5, 0.25, 2.0, 7.5, 1.5, 0.125, -3.0])
+
+def test_schedule_integrals_match_sIntegral():
+    sched = makeSchedule(1, FRONT)
+    flowTimes = sampleTimes()
+    zoneFlows = [0.5, 0.25, 2.0]
+    for toffset in (0.0, 7.5, -61.0, 60.0):  # at 60 s A's first run starts on a sample time
+        sched.setToffset(toffset)
+        assert sched.integrals(zoneFlows, flowTimes).tolist() == expectedIntegrals(sched, zoneFlows, toffset, flowTimes).tolist()
+
+def test_overlapping_runs_of_a_zone_both_count():
+    sched = makeSchedule(1, [(0, 10, 'A'), (5, 10, 'A')])
+    flowTimes = START.timestamp() + np.array([0.0, 300.0, 600.0, 900.0])
+    assert sched.nzones == 1
+    assert sched.integrals([1.0], flowTimes).tolist() == [300.0, 600.0, 300.0, 0.0]
+
+def test_predict_matches_sIntegral():
+    model = twoScheduleModel()
+    flowTimes = sampleTimes()
+    expected = (expectedIntegrals(model.schedList[0], FLOWS[0:3], FLOWS[3], flowTimes) +
+                expectedIntegrals(model.schedList[1], FLOWS[4:6], FLOWS[6], flowTimes))
+    assert model.predict(FLOWS, flowTimes).tolist() == expected.tolist()
+    assert model.batchPredict(np.vstack((FLOWS, FLOWS)), flowTimes).tolist() == [expected.tolist()]*2
+
+def test_jacobian_matches_finite_differences():
+    model = twoScheduleModel()
+    flowTimes = sampleTimes()
+    # toffsets on the half second and steps of a quarter: no window edge crosses a sample time,
+    # and the differences are exact
+    flows = FLOWS + [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.5]
+    jac = model.jacobian(flows, flowTimes)
+    h = 0.25
+    for k in range(len(flows)):
+        dk = np.zeros(len(flows))
+        dk[k] = h
+        numeric = (model.predict(flows + dk, flowTimes) - model.predict(flows - dk, flowTimes))/(2*h)
+        assert jac[:, k].tolist() == numeric.tolist()
+    assert np.any(jac[:, 3] != 0) and np.any(jac[:, 6] != 0)
+
+def test_sparse_jacobian_matches_dense():
+    model = twoScheduleModel()
+    flowTimes = sampleTimes()
+    for flows in (FLOWS, FLOWS + [0.0, 0.0, 0.0, 0.5, 0.0, 0.0, 0.5]):
+        np.testing.assert_array_equal(model.sparseJacobian(flows, flowTimes).toarray(), model.jacobian(flows, flowTimes))
+
+def test_batch_normal_equations_match_dense():
+    model = twoScheduleModel()
+    flowTimes = sampleTimes()
+    flowsArr = np.vstack((FLOWS, FLOWS + [0.0, 0.0, 0.0, 0.5, 0.0, 0.0, 0.5]))
+    rng = np.random.default_rng(0)
+    weights = rng.random((2, len(flowTimes)))
+    resids = rng.normal(size=(2, len(flowTimes)))
+    JtWJ, JtWr = model.batchNormalEquations(flowsArr, flowTimes, weights, resids)
+    for n in range(2):
+        jac = model.jacobian(flowsArr[n], flowTimes)
+        np.testing.assert_allclose(JtWJ[n], np.dot(jac.T*weights[n], jac), rtol=1e-12, atol=1e-9)
+        np.testing.assert_allclose(JtWr[n], np.dot(jac.T*weights[n], resids[n]), rtol=1e-12, atol=1e-9)